@@ -0,0 +1,614 @@
+from time import ctime, time
+from collections import deque
+import asyncio
+import threading
+import csv
+import json
+import os
+from functools import partial
+from analysis import RunningFit
+
+class Step:
+    """One setpoint of an InstrumentGroup measurement.
+
+    Parameters
+    ----------
+    apply : callable, optional
+        Called in an executor at the start of the step, e.g. to change a
+        setpoint. It can return a condition object, whose check method is
+        called for every row and returns a message once the step is finished.
+    rows : int, optional
+        The number of rows to record after the setpoint is applied, waiting
+        wait seconds before each row. If None, rows are recorded continuously
+        until the condition is met or the timeout is reached.
+    wait : float, optional
+        The time to wait before each row in seconds, when rows is given.
+    timeout : float, optional
+        The maximum time of a continuous step in seconds.
+    new_time0 : bool, optional
+        If True, the Time column restarts from zero after apply.
+    setup : bool, optional
+        If True, the step is run again when resuming from a checkpoint, e.g.
+        to set compliances and turn outputs on.
+    resume : callable, optional
+        Called instead of apply when a setup step is run again on resuming,
+        with the index of the first unfinished step, so outputs are set up at
+        the setpoint the measurement continues from.
+    """
+    def __init__(self, apply=None, rows=None, wait=0, timeout=None, new_time0=False, setup=False,
+                 resume=None):
+        self.apply = apply
+        self.rows = rows
+        self.wait = wait
+        self.timeout = timeout
+        self.new_time0 = new_time0
+        self.setup = setup
+        self.resume = resume
+
+class AcquisitionEngine:
+    """Runs an InstrumentGroup measurement as separate asyncio tasks.
+
+    Setpoints are applied by the controller, rows are read by an acquisition
+    task with InstrumentGroup.aread_everything, stop conditions are checked by
+    the controller as the rows arrive and rows are written to file by a writer
+    task. Blocking instrument calls run in executors, so waits and slow replies
+    don't hold up the other tasks.
+
+    The engine runs its own event loop in a separate thread, so it can be used
+    from a Jupyter notebook where an event loop is already running, and can
+    be left running in the background, see InstrumentGroup.start_job. Use 
+    status and progress to follow it, recent_rows for the last rows, and 
+    stop to end it.
+    """
+    def __init__(self, group, title, steps, message=None, end_message=None, recent_rows=1000,
+                 controls_cryostat=False):
+        self.group = group
+        self.title = title
+        self.steps = list(steps)
+        self.message = message
+        self.end_message = end_message
+        # the measurement changes the setpoints of a shared cryostat, see InstrumentGroup.claim_cryostat
+        self.controls_cryostat = controls_cryostat
+        self.time0 = group.now()
+        self.thread = None
+        self.error = None
+        self.finished = threading.Event()
+        # progress
+        self.headers = group.get_headers()
+        self.recent_rows = deque(maxlen=recent_rows)
+        self.step_index = 0
+        self.steps_done = 0
+        self.rows_written = 0
+        self.start_time = None
+        self.end_time = None
+        self.stop_requested = False
+        self.stop_now = False
+        # set by InstrumentGroup.run when a checkpoint journal is used
+        self.journal = None
+        self.checkpoint = None
+        self.last_checkpoint = 0
+
+    async def run(self):
+        group = self.group
+        record = self.checkpoint
+        resuming = record is not None and record["filename"] is not None
+        if resuming:
+            file_writer = group.file_writer(record["filename"],record["position"])
+        else:
+            file_writer = group.file_writer()
+        with file_writer as f:
+            if resuming:
+                print(f"Resuming {self.title} in {file_writer.filename} at setpoint "
+                      f"{record['steps_done']+1} of {len(self.steps)}")
+            elif file_writer.should_write:
+                print(f"Writing data to {file_writer.filename}")
+            elif group.measure:
+                print("Only writing binned data")
+            else:
+                print("Not writing data to file")
+            if self.message:
+                print(self.message)
+            writer = csv.writer(f)
+            if not resuming:
+                writer.writerows([[str(ctime())],[self.title],[group.comment],["[DATA]"]])
+                writer.writerows([self.headers])
+                if record is not None:
+                    record["filename"] = file_writer.filename
+                    record["position"] = f.checkpoint()
+                    self.journal.save(record)
+                    self.last_checkpoint = time()
+            skip = record["steps_done"] if resuming else 0
+            self.names = [channel.name for channel in group.get_channels()]
+            group.analysis.reset()
+            if group.binning is not None:
+                group.binning.reset(self.names)
+            self.rows = asyncio.Queue()
+            writing = asyncio.create_task(self.write_rows(writer,f))
+            try:
+                self.time0 = self.group.now()
+                for i,step in enumerate(self.steps):
+                    if self.stop_requested:
+                        break
+                    self.step_index = i
+                    if group.analysis.per_setpoint:
+                        # the rows of the last setpoint are analysed first
+                        await self.rows.join()
+                    group.analysis.new_setpoint(i)
+                    if i < skip:
+                        # completed before, only setup steps are run again
+                        if step.setup:
+                            await self.run_step(step,first=skip)
+                        self.steps_done = i+1
+                        continue
+                    if resuming and i == skip:
+                        self.time0 = self.group.now()-record["elapsed"]
+                    await self.run_step(step)
+                    if not self.stop_now:
+                        self.steps_done = i+1
+                        await self.save_checkpoint(f)
+                if record is not None and not self.stop_requested:
+                    record["finished"] = True
+                    self.journal.save(record)
+                elif record is not None and not self.stop_now:
+                    # stopped after a whole setpoint, record it even within the interval
+                    await self.save_checkpoint(f,force=True)
+            finally:
+                await self.rows.put(None)
+                await writing
+                group.analysis.new_setpoint(None)
+                if group.binning is not None:
+                    group.write_binned(self.title,file_writer.filename)
+                # other groups sharing the cryostat may change it again
+                group.release_cryostat()
+        if self.stop_requested:
+            print(f"Measurement stopped after {self.steps_done} of {len(self.steps)} setpoints")
+        elif self.end_message:
+            print(self.end_message)
+
+    async def write_rows(self, writer, f):
+        while True:
+            data = await self.rows.get()
+            self.rows.task_done()
+            if data is None:
+                break
+            writer.writerows([data])
+            f.flush()
+            values = dict(zip(self.names,data))
+            self.group.analysis.update(values)
+            if self.group.binning is not None:
+                self.group.binning.update(values)
+            self.recent_rows.append(data)
+            self.rows_written += 1
+
+    async def save_checkpoint(self, f, force=False):
+        """Records the finished setpoints and the file position in the journal,
+        at most once every journal.interval seconds unless force is True"""
+        if self.checkpoint is None:
+            return
+        if not force and time()-self.last_checkpoint < self.journal.interval:
+            return
+        self.last_checkpoint = time()
+        await self.rows.join()
+        self.checkpoint["steps_done"] = self.steps_done
+        self.checkpoint["position"] = f.checkpoint()
+        self.checkpoint["elapsed"] = self.group.now()-self.time0
+        self.journal.save(self.checkpoint)
+
+    async def acquire(self, stop, checks):
+        """Reads rows continuously until stop is set"""
+        while not stop.is_set():
+            data = await self.group.aread_everything(time0=self.time0)
+            await self.rows.put(data)
+            await checks.put(dict(zip(self.names,data)))
+
+    async def run_step(self, step, first=None):
+        loop = asyncio.get_running_loop()
+        condition = None
+        apply = step.apply
+        if first is not None and step.resume:
+            apply = partial(step.resume,first)
+        if apply:
+            condition = await loop.run_in_executor(None,apply)
+        if step.new_time0:
+            self.time0 = self.group.now()
+        if step.rows is not None:
+            for i in range(step.rows):
+                if self.stop_now:
+                    break
+                await asyncio.sleep(step.wait)
+                await self.rows.put(await self.group.aread_everything(time0=self.time0))
+            return
+
+        stop = asyncio.Event()
+        checks = asyncio.Queue()
+        acquiring = asyncio.create_task(self.acquire(stop,checks))
+        start = self.group.now()
+        try:
+            while True:
+                getting = asyncio.create_task(checks.get())
+                await asyncio.wait({getting,acquiring},return_when=asyncio.FIRST_COMPLETED)
+                if not getting.done():
+                    # acquisition stopped with an error
+                    getting.cancel()
+                    acquiring.result()
+                values = getting.result()
+                elapsed = self.group.now()-start
+                if condition:
+                    message = await loop.run_in_executor(None,condition.check,values,elapsed)
+                    if message:
+                        print(message)
+                        break
+                if step.timeout is not None and elapsed > step.timeout:
+                    print("Timeout reached")
+                    break
+                if self.stop_now:
+                    break
+        finally:
+            stop.set()
+            await asyncio.gather(acquiring,return_exceptions=True)
+
+    def start(self):
+        """Starts the measurement in a separate thread"""
+        self.start_time = time()
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self.run())
+        self.thread = threading.Thread(target=self.run_thread,daemon=True)
+        self.thread.start()
+
+    def run_thread(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError as err:
+            self.error = err
+        except BaseException as err:
+            self.error = err
+            print(f"Measurement failed: {err!r}")
+        finally:
+            self.end_time = time()
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+            self.loop.close()
+            self.finished.set()
+
+    def cancel(self):
+        """Stops the measurement after the current instrument calls"""
+        if self.thread and not self.finished.is_set():
+            try:
+                self.loop.call_soon_threadsafe(self.task.cancel)
+            except RuntimeError:
+                pass  # the loop has already closed
+
+    def stop(self, now=False):
+        """Stops the measurement gracefully.
+
+        By default the current setpoint is finished first, with now=True the 
+        measurement stops after the current row. A measurement of a single
+        continuous step, e.g. measure_until_interrupted, follow_cryostat or
+        sweep_heater, always stops after the current row, as its only 
+        setpoint lasts until its condition or timeout.
+        """
+        if len(self.steps) == 1 and self.steps[0].rows is None:
+            now = True
+        self.stop_requested = True
+        self.stop_now = now
+
+    def done(self):
+        return self.finished.is_set()
+
+    @property
+    def status(self):
+        if self.start_time is None:
+            return "not started"
+        if not self.finished.is_set():
+            return "stopping" if self.stop_requested else "running"
+        if isinstance(self.error,asyncio.CancelledError):
+            return "cancelled"
+        if self.error is not None:
+            return "failed"
+        if self.stop_requested:
+            return "stopped"
+        return "finished"
+
+    def progress(self):
+        """Returns a dictionary describing the progress of the measurement.
+
+        The ETA in seconds is estimated from the average time of the finished 
+        setpoints, it is None until the first setpoint is finished.
+        """
+        if self.start_time is None:
+            elapsed = 0
+        else:
+            elapsed = (self.end_time or time()) - self.start_time
+        eta = None
+        if self.finished.is_set():
+            eta = 0
+        elif self.steps_done:
+            eta = elapsed/self.steps_done*(len(self.steps)-self.steps_done)
+        return {"status": self.status,
+                "setpoint": self.step_index+1,
+                "setpoints": len(self.steps),
+                "rows_written": self.rows_written,
+                "rows_per_s": self.rows_written/elapsed if elapsed else 0,
+                "elapsed_s": elapsed,
+                "eta_s": eta}
+
+    def print_progress(self):
+        p = self.progress()
+        eta = "unknown" if p["eta_s"] is None else f"{p['eta_s']/60:.1f} min"
+        print(f"{self.title}: {p['status']}, setpoint {p['setpoint']} of {p['setpoints']}, "
+              f"{p['rows_written']} rows, {p['rows_per_s']:.2f} rows/s, "
+              f"elapsed {p['elapsed_s']/60:.1f} min, ETA {eta}")
+
+    def wait(self):
+        """Waits for the measurement to finish and raises any error from it.
+
+        On KeyboardInterrupt the measurement is cancelled before re-raising.
+        """
+        try:
+            # wait with a timeout so Ctrl+C is handled on all platforms
+            while not self.finished.wait(0.1):
+                pass
+        except KeyboardInterrupt:
+            self.cancel()
+            self.finished.wait()
+            raise
+        if self.error is not None and not isinstance(self.error,asyncio.CancelledError):
+            raise self.error
+
+class RampTCondition:
+    """Stop condition for InstrumentGroup.ramp_T.
+
+    The ramp is finished when the temperature is within threshold of the
+    setpoint, or has stopped changing by more than base_T_threshold, for
+    enough consecutive rows, the temperature has oscillated around its final
+    value and min_time has passed.
+    """
+    def __init__(self, iTC, controller, T, threshold, base_T_threshold, min_time):
+        self.iTC = iTC
+        self.controller = controller
+        self.T = T
+        self.threshold = threshold
+        self.base_T_threshold = base_T_threshold
+        self.min_time = min_time
+        self.T_reached = 0
+        self.T_stopped = 0
+        self.T_diff_sign_change = 0
+        self.prev_VTI_T = 0
+        self.prev_VTI_diff = 0
+        self.prev_probe_T = 0
+        self.prev_probe_diff = 0
+
+    def check(self, values, elapsed):
+        # use the temperatures in the row if they are recorded
+        if "T_probe" in values:
+            probe_T = values["T_probe"]
+        else:
+            probe_T = self.iTC.call(self.iTC.get_probe_temp)
+        if "T_VTI" in values:
+            VTI_T = values["T_VTI"]
+        else:
+            VTI_T = self.iTC.call(self.iTC.get_VTI_temp)
+        return self.update(probe_T,VTI_T,elapsed)
+
+    def update(self, probe_T, VTI_T, elapsed):
+        T = self.T
+        threshold = self.threshold
+        base_T_threshold = self.base_T_threshold
+        probe_diff = probe_T - self.prev_probe_T
+        VTI_diff = VTI_T - self.prev_VTI_T
+        match self.controller:
+            case "probe":
+                if abs(probe_T-T) < threshold:
+                    self.T_reached += 1
+                else:
+                    self.T_reached -= 10
+                if abs(probe_diff) < base_T_threshold:
+                    self.T_stopped += 1
+                else:
+                    self.T_stopped -= 10
+                    if self.T_reached<0: # both conditions not met
+                        self.T_diff_sign_change -= 5
+                if probe_diff*self.prev_probe_diff<0:
+                    self.T_diff_sign_change += 1
+            case "VTI":
+                if abs(VTI_T-T) < threshold:
+                    self.T_reached += 1
+                else:
+                    self.T_reached = -10
+                if abs(VTI_diff) < base_T_threshold:
+                    self.T_stopped += 1
+                else:
+                    self.T_stopped -= 10
+                    if self.T_reached<0: # both conditions not met
+                        self.T_diff_sign_change -= 5
+                if VTI_diff*self.prev_VTI_diff<0:
+                    self.T_diff_sign_change += 1
+            case "both":
+                if (abs(probe_T-T) < threshold) and (abs(VTI_T-T) < threshold):
+                    self.T_reached += 1
+                else:
+                    self.T_reached = -10
+                if (abs(probe_diff) < base_T_threshold) and (abs(VTI_diff) < base_T_threshold):
+                    self.T_stopped += 1
+                else:
+                    self.T_stopped -= 10
+                    if self.T_reached<0: # both conditions not met
+                        self.T_diff_sign_change -= 5
+                if (probe_diff*self.prev_probe_diff<0) or (VTI_diff*self.prev_VTI_diff<0):
+                    self.T_diff_sign_change += 1
+        if self.T_reached<0:
+            self.T_reached=0
+        if self.T_stopped<0:
+            self.T_stopped=0
+        if self.T_diff_sign_change<0:
+            self.T_diff_sign_change=0
+        self.prev_probe_T = probe_T
+        self.prev_VTI_T = VTI_T
+        self.prev_probe_diff = probe_diff
+        self.prev_VTI_diff = VTI_diff
+
+        if (self.T_reached >= 30) and (self.T_diff_sign_change>=5) and (elapsed > self.min_time):
+            return f"Finished ramping {self.controller} to {T} K"
+        if (self.T_stopped >= 50) and (self.T_diff_sign_change>=5) and (elapsed > self.min_time):
+            return f"Reached base T in {self.controller} at {probe_T} K probe, {VTI_T} K VTI"
+        return None
+
+    def estimate(self, row_time):
+        """Returns the expected duration in seconds, the ramp and 30 rows at 
+        the setpoint"""
+        return self.min_time + 30*row_time
+
+class RampBCondition:
+    """Stop condition for InstrumentGroup.ramp_B.
+
+    The ramp is finished when the field is within threshold of the setpoint
+    for 10 consecutive rows and min_time has passed.
+    """
+    def __init__(self, iPS, B, threshold, min_time):
+        self.iPS = iPS
+        self.B = B
+        self.threshold = threshold
+        self.min_time = min_time
+        self.B_reached = 0
+
+    def check(self, values, elapsed):
+        # use the field in the row if it is recorded
+        if "B" in values:
+            B = values["B"]
+        else:
+            B = self.iPS.call(self.iPS.get_field)
+        return self.update(B,elapsed)
+
+    def update(self, B, elapsed):
+        if abs(B-self.B) < self.threshold:
+            self.B_reached += 1
+        else:
+            self.B_reached = 0
+        if (self.B_reached >= 10) and (elapsed > self.min_time):
+            return f"Finished ramping magnet to {self.B} T"
+        return None
+
+    def estimate(self, row_time):
+        """Returns the expected duration in seconds, the ramp and 10 rows at 
+        the setpoint"""
+        return self.min_time + 10*row_time
+
+class HeaterSweepCondition:
+    """Feedback loop and stop condition for InstrumentGroup.sweep_heater.
+
+    The sweep rate is the slope of a straight line fit of temperature against
+    time over the last window rows. Every window//2 rows the heater power is
+    changed by gain times the difference between the target and measured
+    rates, raising the power to heat faster or cool slower and lowering it
+    otherwise. The sweep is finished when the temperature passes T_end.
+    """
+    def __init__(self, iTC, controller, T_start, T_end, heater, rate=None, dT_per_row=None,
+                 max_heater=100, gain=1, window=20):
+        self.iTC = iTC
+        self.controller = controller
+        self.T_start = T_start
+        self.T_end = T_end
+        self.direction = 1 if T_end >= T_start else -1
+        self.heater = heater
+        self.rate = rate
+        self.dT_per_row = dT_per_row
+        self.max_heater = max_heater
+        self.gain = gain
+        self.window = window
+        self.fit = RunningFit("t","T",window)
+        self.rows = 0
+        self.at_limit = False
+
+    def check(self, values, elapsed):
+        name = f"T_{self.controller}"
+        if name in values:
+            T = values[name]
+        elif self.controller == "probe":
+            T = self.iTC.call(self.iTC.get_probe_temp)
+        else:
+            T = self.iTC.call(self.iTC.get_VTI_temp)
+        heater = self.update(T,elapsed)
+        if heater is not None:
+            if self.controller == "probe":
+                self.iTC.call(self.iTC.set_probe_heater,heater)
+            else:
+                self.iTC.call(self.iTC.set_VTI_heater,heater)
+        if self.direction*(T-self.T_end) >= 0:
+            return f"Finished heater sweep of {self.controller} to {self.T_end} K"
+        return None
+
+    def target_rate(self, elapsed):
+        """Returns the target sweep rate in K/min"""
+        if self.dT_per_row is not None:
+            return 60*self.dT_per_row*self.rows/elapsed if elapsed > 0 else 0
+        return self.rate
+
+    def update(self, T, elapsed):
+        """Adds a row, returns the new heater power when it is changed"""
+        self.rows += 1
+        self.fit.update({"t": elapsed/60, "T": T})
+        if self.rows < self.window or self.rows % max(self.window//2,1):
+            return None
+        measured = self.direction*self.fit.results()["slope"]
+        if measured != measured:  # NaN
+            return None
+        heater = self.heater + self.direction*self.gain*(self.target_rate(elapsed)-measured)
+        heater = min(max(heater,0),self.max_heater)
+        if heater in (0,self.max_heater) and not self.at_limit:
+            # only reported once per sweep
+            print(f"{self.controller} heater at {heater} %, the target rate may not be reached")
+            self.at_limit = True
+        self.heater = heater
+        return heater
+
+    def estimate(self, row_time):
+        """Returns the expected duration in seconds at the target rate"""
+        if self.dT_per_row is not None:
+            return abs(self.T_end-self.T_start)/self.dT_per_row*row_time
+        return 60*abs(self.T_end-self.T_start)/self.rate
+
+class CheckpointJournal:
+    """Records the progress of the measurements of a script in a file.
+
+    Each measurement is identified by its position in the script, counting 
+    from when the journal was opened, with its title and filename. A record 
+    with the setpoints done, the data file and the position in it is appended
+    to the journal after a setpoint, at most once every interval seconds, so 
+    the last record of each measurement survives a crash. Setpoints after it
+    are measured again on resuming.
+    """
+    def __init__(self, filename, interval=60):
+        self.filename = filename
+        self.interval = interval
+        self.records = {}
+        self.calls = 0
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # partly written line
+                    self.records[record["call"]] = record
+
+    def next(self, title, filename):
+        """Returns the record of the next measurement of the script"""
+        call = self.calls
+        self.calls += 1
+        record = self.records.get(call)
+        if record is not None and (record["title"],record["requested"]) != (title,filename):
+            print(f"Checkpoint journal does not match measurement {call} ({title}, {filename}), "
+                  "measuring it and the following ones again")
+            self.records = {k:v for k,v in self.records.items() if k < call}
+            record = None
+        if record is None:
+            record = {"call": call, "title": title, "requested": filename, "filename": None,
+                      "steps_done": 0, "position": None, "elapsed": 0, "finished": False}
+        return record
+
+    def save(self, record):
+        self.records[record["call"]] = dict(record)
+        with open(self.filename,'a') as f:
+            f.write(json.dumps(record)+"\n")
+            f.flush()
+            os.fsync(f.fileno())
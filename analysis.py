@@ -0,0 +1,281 @@
+import math
+import threading
+import numpy as np
+from collections import deque
+
+class RunningStats:
+    """Mean, standard deviation and extremes of a column, updated row by row.
+
+    Uses Welford's algorithm, so memory doesn't grow with the number of rows.
+    With a window only the last window rows are included, and those rows are
+    kept to be removed again. NaN values are skipped.
+
+    Parameters
+    ----------
+    column : str
+        The channel name, e.g. "R_AA".
+    window : int, optional
+        The number of most recent rows to include. Default is all rows.
+    """
+    def __init__(self, column, window=None):
+        self.column = column
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.values = deque() if self.window else None
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta/self.n
+        self.M2 += delta*(x - self.mean)
+        self.min = min(self.min,x)
+        self.max = max(self.max,x)
+
+    def remove(self, x):
+        if self.n == 1:
+            self.n, self.mean, self.M2 = 0, 0.0, 0.0
+            return
+        mean = self.mean
+        self.n -= 1
+        self.mean -= (x - mean)/self.n
+        self.M2 = max(self.M2 - (x - self.mean)*(x - mean), 0.0)
+
+    def update(self, values):
+        x = values.get(self.column)
+        if x is None or math.isnan(x):
+            return
+        self.add(x)
+        if self.window:
+            self.values.append(x)
+            if len(self.values) > self.window:
+                self.remove(self.values.popleft())
+                # extremes of the window
+                self.min = min(self.values)
+                self.max = max(self.values)
+
+    def results(self):
+        std = math.sqrt(self.M2/(self.n-1)) if self.n > 1 else math.nan
+        return {"n": self.n,
+                "mean": self.mean if self.n else math.nan,
+                "std": std,
+                "sem": std/math.sqrt(self.n) if self.n > 1 else math.nan,
+                "min": self.min if self.n else math.nan,
+                "max": self.max if self.n else math.nan}
+
+class RunningFit:
+    """Least squares straight line fit of y against x, updated row by row.
+
+    Keeps the means and co-moments of x and y, so e.g. a Hall slope of R(B)
+    or dR/dT is available at any time without refitting the whole file. With
+    a window only the last window rows are fitted. Rows where x or y is NaN
+    are skipped.
+
+    Parameters
+    ----------
+    x, y : str
+        The channel names, e.g. "B" and "R_AA".
+    window : int, optional
+        The number of most recent rows to fit. Default is all rows.
+    """
+    def __init__(self, x, y, window=None):
+        self.x = x
+        self.y = y
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.reset_sums()
+        self.points = deque() if self.window else None
+
+    def reset_sums(self):
+        self.n = 0
+        self.mx = self.my = 0.0
+        self.Cxx = self.Cyy = self.Cxy = 0.0
+
+    def add(self, x, y):
+        self.n += 1
+        dx = x - self.mx
+        dy = y - self.my
+        self.mx += dx/self.n
+        self.my += dy/self.n
+        self.Cxx += dx*(x - self.mx)
+        self.Cyy += dy*(y - self.my)
+        self.Cxy += dx*(y - self.my)
+
+    def remove(self, x, y):
+        if self.n == 1:
+            self.reset_sums()
+            return
+        mx, my = self.mx, self.my
+        self.n -= 1
+        self.mx -= (x - mx)/self.n
+        self.my -= (y - my)/self.n
+        self.Cxx -= (x - self.mx)*(x - mx)
+        self.Cyy -= (y - self.my)*(y - my)
+        self.Cxy -= (x - self.mx)*(y - my)
+
+    def update(self, values):
+        x = values.get(self.x)
+        y = values.get(self.y)
+        if x is None or y is None or math.isnan(x) or math.isnan(y):
+            return
+        self.add(x,y)
+        if self.window:
+            self.points.append((x,y))
+            if len(self.points) > self.window:
+                self.remove(*self.points.popleft())
+
+    def results(self):
+        if self.n < 2 or self.Cxx <= 0:
+            return {"n": self.n, "slope": math.nan, "intercept": math.nan,
+                    "slope_err": math.nan, "r2": math.nan}
+        slope = self.Cxy/self.Cxx
+        residual = max(self.Cyy - slope*self.Cxy, 0.0)
+        return {"n": self.n,
+                "slope": slope,
+                "intercept": self.my - slope*self.mx,
+                "slope_err": math.sqrt(residual/(self.n-2)/self.Cxx) if self.n > 2 else math.nan,
+                "r2": self.Cxy**2/(self.Cxx*self.Cyy) if self.Cyy > 0 else math.nan}
+
+class StreamAnalysis:
+    """Named running statistics and fits, updated with every row written.
+
+    Results are reset at the start of each measurement. Analyses added with
+    per_setpoint=True are also reset at every setpoint, and the results of
+    each finished setpoint are kept in history, e.g. to average repeated
+    points.
+    """
+    def __init__(self):
+        self.analyses = {}
+        self.per_setpoint = set()
+        self.history = []
+        self.setpoint = None
+        self.lock = threading.Lock()
+
+    def add(self, name, analysis, per_setpoint=False):
+        with self.lock:
+            self.analyses[name] = analysis
+            if per_setpoint:
+                self.per_setpoint.add(name)
+
+    def remove(self, name=None):
+        """Removes one analysis, or all of them if name is None"""
+        with self.lock:
+            if name is None:
+                self.analyses = {}
+                self.per_setpoint = set()
+            else:
+                if name not in self.analyses:
+                    raise ValueError(f"No analysis named {name}, use one of {list(self.analyses)}")
+                self.analyses.pop(name)
+                self.per_setpoint.discard(name)
+
+    def reset(self):
+        with self.lock:
+            for analysis in self.analyses.values():
+                analysis.reset()
+            self.history = []
+            self.setpoint = None
+
+    def new_setpoint(self, index):
+        """Keeps the per setpoint results of the last setpoint and resets them.
+        index is None at the end of the measurement."""
+        with self.lock:
+            if not self.per_setpoint:
+                return
+            if self.setpoint is not None:
+                self.history.append({"setpoint": self.setpoint,
+                                     **{name: self.analyses[name].results() for name in self.per_setpoint}})
+            for name in self.per_setpoint:
+                self.analyses[name].reset()
+            self.setpoint = index
+
+    def update(self, values):
+        with self.lock:
+            for analysis in self.analyses.values():
+                analysis.update(values)
+
+    def results(self):
+        with self.lock:
+            return {name: analysis.results() for name,analysis in self.analyses.items()}
+
+class GridBinner:
+    """Averages rows onto a uniform grid of one column as they arrive.
+
+    Each row goes into the bin whose grid point, a multiple of step, is 
+    nearest to its value of x. Every bin keeps the count, mean and standard
+    error of each column with Welford's algorithm, so memory grows with the
+    number of bins, not rows. NaN values are skipped.
+
+    Parameters
+    ----------
+    x : str
+        The channel to bin on, e.g. "B", "T_probe" or "Vg_A".
+    step : float
+        The grid spacing.
+    columns : list of str, optional
+        The channels to average. Default is every channel except Time.
+    raw : bool, optional
+        If False, only the binned file is written. Default is True.
+    """
+    def __init__(self, x, step, columns=None, raw=True):
+        if not step > 0:
+            raise ValueError("The bin step must be positive")
+        self.x = x
+        self.step = step
+        self.columns = columns
+        self.raw = raw
+        self.reset([])
+
+    def reset(self, names):
+        """Empties the bins and sets the columns from the channel names"""
+        self.names = list(self.columns) if self.columns else [name for name in names if name != "Time"]
+        # {bin index: [count, mean, M2]} with an array entry per column
+        self.bins = {}
+
+    def update(self, values):
+        x = values.get(self.x)
+        if x is None or math.isnan(x):
+            return
+        index = round(x/self.step)
+        if index not in self.bins:
+            size = len(self.names)
+            self.bins[index] = [np.zeros(size),np.zeros(size),np.zeros(size)]
+        n,mean,M2 = self.bins[index]
+        v = np.array([values.get(name,np.nan) for name in self.names],dtype=float)
+        valid = ~np.isnan(v)
+        n[valid] += 1
+        delta = v[valid] - mean[valid]
+        mean[valid] += delta/n[valid]
+        M2[valid] += delta*(v[valid] - mean[valid])
+
+    def headers(self, units):
+        """Returns the headers of the binned file, units maps names to units"""
+        def header(name):
+            return f"{name} ({units[name]})" if units.get(name) else name
+        headers = [header(self.x).replace(self.x,f"{self.x}_bin",1),"n"]
+        for name in self.names:
+            headers += [header(name),header(name).replace(name,f"{name}_err",1)]
+        return headers
+
+    def rows(self):
+        """Returns the bins as rows sorted by grid point, with the number of 
+        rows in the bin and the mean and standard error of each column"""
+        rows = []
+        for index in sorted(self.bins):
+            n,mean,M2 = self.bins[index]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                err = np.where(n > 1,np.sqrt(M2/np.maximum(n-1,1)/n),np.nan)
+            mean = np.where(n > 0,mean,np.nan)
+            row = [round(index*self.step,12),int(n.max())]
+            for m,e in zip(mean,err):
+                row += [m,e]
+            rows.append(row)
+        return rows
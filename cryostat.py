@@ -0,0 +1,89 @@
+import threading
+from time import monotonic
+
+class Cryostat:
+    """The MercuryiTC and MercuryiPS shared by several InstrumentGroups.
+
+    One group at a time owns the cryostat and may change its setpoints. It
+    publishes every temperature and field it reads, and the other groups
+    subscribe: they record the published values instead of querying the
+    Mercury controllers, while reading their own sourcemeters and voltmeters
+    in parallel, each group writing its own file.
+
+    Parameters
+    ----------
+    iTC : MercuryiTC object, optional
+    iPS : MercuryiPS object, optional
+    max_age : float, optional
+        Published values older than max_age seconds are read from the
+        controller again. Default is 5.
+    """
+    def __init__(self, iTC=None, iPS=None, max_age=5):
+        self.iTC = iTC
+        self.iPS = iPS
+        self.max_age = max_age
+        self.owner = None
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def claim(self, group):
+        """Makes group the owner, unless another owner is measuring"""
+        with self.lock:
+            if self.owner is not None and self.owner is not group and self.owner.busy():
+                raise RuntimeError("The cryostat is controlled by a measurement of another group, "
+                                   "wait for it to finish or stop it")
+            self.owner = group
+
+    def release(self, group):
+        with self.lock:
+            if self.owner is group:
+                self.owner = None
+
+    def publish(self, name, value):
+        with self.lock:
+            self.state[name] = (value,monotonic())
+
+    def read(self, group, name, getter):
+        """Returns the value of a channel for group.
+
+        The owner, or any group while there is no owner, reads the controller
+        and publishes the value. Subscribers get the published value while it
+        is recent, otherwise they read the controller themselves.
+        """
+        with self.lock:
+            subscriber = self.owner is not None and self.owner is not group
+            published = self.state.get(name)
+        if subscriber and published is not None and monotonic()-published[1] <= self.max_age:
+            return published[0]
+        value = getter()
+        self.publish(name,value)
+        return value
+
+class OwnerFinishedCondition:
+    """Stop condition for InstrumentGroup.follow_cryostat, finished once
+    the measurement of the cryostat owner has run and ended, or when no
+    other group has been measuring with the cryostat for grace seconds."""
+    def __init__(self, cryostat, group, grace=30):
+        self.cryostat = cryostat
+        self.group = group
+        self.grace = grace
+        self.seen_running = False
+        self.idle_since = None
+
+    def check(self, values, elapsed):
+        owner = self.cryostat.owner
+        if owner is not None and owner is not self.group and owner.busy():
+            self.seen_running = True
+            self.idle_since = None
+            return None
+        if self.seen_running:
+            return "The cryostat measurement has finished"
+        if self.idle_since is None:
+            self.idle_since = elapsed
+        if elapsed-self.idle_since >= self.grace:
+            return "No other measurement is controlling the cryostat"
+        return None
+
+    def estimate(self, row_time):
+        # a dry run has no other measurement running, so only the grace period is counted
+        return self.grace
@@ -0,0 +1,266 @@
+import re
+import csv
+import io
+import json
+import asyncio
+import pyvisa
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from sweep import format_duration
+
+# setpoint a simulated Mercury signal follows, so ramps finish at their setpoint
+SIGNALS = {"DEV:GRPZ:PSU:SIG:FLD": "DEV:GRPZ:PSU:SIG:FSET",
+           "DEV:GRPZ:PSU:SIG:RFLD": "DEV:GRPZ:PSU:SIG:RFST",
+           "DEV:MB0.H1:TEMP:SIG:TEMP": "DEV:DB8.T1:TEMP:LOOP:TSET",
+           "DEV:MB1.T1:TEMP:SIG:TEMP": "DEV:MB1.T1:TEMP:LOOP:TSET"}
+# units appended to simulated Mercury replies, as stripped by the getters
+UNITS = {"TEMP": "K", "TSET": "K", "RSET": "K/m", "FLD": "T", "FSET": "T", "RFLD": "T/min",
+         "VOLT": "V", "CURR": "A", "PRES": "mB"}
+
+def command_template(command):
+    """Returns the command with a trailing number replaced by #, so setpoints
+    share one latency"""
+    return re.sub(r'([ :])[-+0-9.eE]+$', r'\1#', command)
+
+class LatencyModel:
+    """Measured communication times of the instruments of an InstrumentGroup.
+
+    Holds the mean time per command template and instrument, the time to read
+    one row, and the last reply to each query, which simulated instruments
+    start from. Use calibrate with the real instruments connected, save it,
+    and load it to plan measurements later.
+    """
+    def __init__(self, times=None, row_time=0.5, responses=None, default=0.02):
+        # {address: {template: [total seconds, count]}}
+        self.times = times or {}
+        self.row_time = row_time
+        self.responses = responses or {}
+        self.default = default
+
+    @classmethod
+    def calibrate(cls, group, rows=5):
+        """Reads rows from the group and times every command sent.
+
+        Only reads, no setpoints are changed. Setters which were not timed
+        use the mean time of the other commands of their instrument.
+        """
+        model = cls()
+        instruments = group.get_instruments()
+        for instrument in instruments:
+            instrument.instr = TimingResource(instrument.instr,model,instrument.GPIB_address)
+        try:
+            row_times = []
+            with ThreadPoolExecutor(1) as pool:
+                for i in range(rows):
+                    start = perf_counter()
+                    pool.submit(asyncio.run,group.aread_everything()).result()
+                    row_times.append(perf_counter()-start)
+        finally:
+            for instrument in instruments:
+                instrument.instr = instrument.instr.instr
+        model.row_time = sum(row_times)/len(row_times)
+        print(f"Row time {model.row_time*1000:.1f} ms, {sum(len(t) for t in model.times.values())} commands timed")
+        return model
+
+    def record(self, address, command, seconds):
+        entry = self.times.setdefault(address,{}).setdefault(command_template(command),[0,0])
+        entry[0] += seconds
+        entry[1] += 1
+
+    def latency(self, address, command):
+        """Returns the expected time of a command in seconds"""
+        times = self.times.get(address,{})
+        entry = times.get(command_template(command))
+        if entry:
+            return entry[0]/entry[1]
+        if times:
+            return sum(t for t,n in times.values())/sum(n for t,n in times.values())
+        return self.default
+
+    def save(self, filename):
+        with open(filename,'w') as f:
+            json.dump({"times": self.times, "row_time": self.row_time,
+                       "responses": self.responses, "default": self.default},f,indent=1)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls(**json.load(f))
+
+class TimingResource:
+    """Wraps a VISA resource and records the time of each command in a
+    LatencyModel"""
+    def __init__(self, instr, model, address):
+        self.instr = instr
+        self.model = model
+        self.address = address
+
+    def __getattr__(self, name):
+        return getattr(self.instr, name)
+
+    def __setattr__(self, name, value):
+        if name in ("instr","model","address"):
+            object.__setattr__(self,name,value)
+        else:
+            setattr(self.instr,name,value)
+
+    def query(self, command):
+        start = perf_counter()
+        response = self.instr.query(command)
+        self.model.record(self.address,command,perf_counter()-start)
+        self.model.responses.setdefault(self.address,{})[command] = response
+        return response
+
+    def write(self, command):
+        start = perf_counter()
+        result = self.instr.write(command)
+        self.model.record(self.address,command,perf_counter()-start)
+        return result
+
+class SimulatedResource:
+    """Answers an instrument's commands from the setpoints written to it.
+
+    Replies start from those recorded in the LatencyModel. Each command adds
+    its modelled time to the dry run clock instead of waiting for it.
+    """
+    def __init__(self, model, address, kind, dry):
+        self.model = model
+        self.address = address
+        self.kind = kind
+        self.dry = dry
+        self.responses = model.responses.get(address,{})
+        self.state = {}
+        self.pending = []
+        self.timeout = 2000
+
+    def query(self, command):
+        self.dry.elapsed += self.model.latency(self.address,command)
+        return self.respond(command)
+
+    def respond(self, command):
+        if ';' in command:
+            # a batched message is one transfer, its queries are answered together
+            replies = [self.respond(part) for part in command.split(';')]
+            return ';'.join(reply for reply in replies if reply is not None)
+        if command == '*IDN?':
+            return 'IDN:SIMULATED'
+        if command == '*OPC?':
+            return '1'
+        if command.startswith('SET:'):
+            path,_,value = command[4:].rpartition(':')
+            self.state[path] = value
+            return f'STAT:SET:{path}:{value}:VALID'
+        if '?' not in command:
+            self.apply(command)
+            return None
+        if command.startswith('READ:'):
+            path = command[5:-1]
+            setpoint = self.state.get(path,self.state.get(SIGNALS.get(path)))
+            if setpoint is not None:
+                unit = "" if "DB5" in path else UNITS.get(path.split(':')[-1],"")
+                return f'STAT:{path}:{setpoint}{unit}'
+        if command[:-1].lstrip(':') in self.state:
+            return self.state[command[:-1].lstrip(':')]
+        if command in self.responses:
+            return self.responses[command]
+        if command.startswith('READ:'):
+            path = command[5:-1]
+            return f'STAT:{path}:0{"" if "DB5" in path else UNITS.get(path.split(":")[-1],"")}'
+        if self.kind == 'VSourcemeter' and command == ':READ?':
+            return '0,0'
+        return '0'
+
+    def write(self, command):
+        self.dry.elapsed += self.model.latency(self.address,command)
+        if command == '*IDN?':
+            self.pending.append('IDN:SIMULATED')
+        else:
+            for part in command.split(';'):
+                self.apply(part)
+
+    def apply(self, command):
+        if ' ' in command:
+            setting,value = command.split(' ',1)
+            # SCPI instruments reply to boolean settings with 1 or 0
+            self.state[setting.lstrip(':')] = {"ON": "1", "OFF": "0"}.get(value.upper(),value)
+
+    def read(self):
+        if self.pending:
+            return self.pending.pop(0)
+        raise pyvisa.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+
+    def clear(self):
+        self.pending = []
+
+class DryRun:
+    """Runs a measurement script against simulated instruments.
+
+    Every measurement mode applies its setpoints to the simulated instruments,
+    but rows are counted instead of read and waits are added to a clock
+    instead of slept. Continuous steps take as long as their stop condition
+    estimates, or their timeout. The estimated duration, rows and file size
+    of each measurement are collected in segments.
+    """
+    def __init__(self, group, model):
+        self.group = group
+        self.model = model
+        self.elapsed = 0
+        self.segments = []
+        # time spent in InstrumentGroup.sleep between measurements
+        self.waits = 0
+
+    def row_bytes(self):
+        """Returns the size of the header and of one row in the data file"""
+        elapsed = self.elapsed
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerows([["Mon Jan  1 00:00:00 2024"],["title"],[self.group.comment],["[DATA]"]])
+        writer.writerows([self.group.get_headers()])
+        header = len(text.getvalue())
+        text = io.StringIO()
+        csv.writer(text).writerows([self.group.read_everything()])
+        self.elapsed = elapsed
+        return header,len(text.getvalue())
+
+    def run(self, engine):
+        group = self.group
+        row_time = self.model.row_time
+        header,row = self.row_bytes()
+        segment = {"title": engine.title, "filename": group.filename if group.measure else None,
+                   "setpoints": len(engine.steps), "rows": 0, "seconds": 0, "bytes": 0, "notes": []}
+        start = self.elapsed
+        for step in engine.steps:
+            condition = step.apply() if step.apply else None
+            if step.rows is not None:
+                self.elapsed += step.rows*(step.wait+row_time)
+                segment["rows"] += step.rows
+                continue
+            duration = condition.estimate(row_time) if condition is not None else None
+            if step.timeout is not None and (duration is None or duration > step.timeout):
+                duration = step.timeout
+                segment["notes"].append("timeout")
+            if duration is None:
+                segment["notes"].append("runs until stopped, not counted")
+                duration = 0
+            self.elapsed += duration
+            segment["rows"] += int(duration/row_time)
+        segment["seconds"] = self.elapsed-start
+        if segment["filename"] is not None:
+            segment["bytes"] = header + segment["rows"]*row
+        self.segments.append(segment)
+
+    def sleep(self, seconds):
+        self.elapsed += seconds
+        self.waits += seconds
+
+    def print_report(self):
+        rows = sum(segment["rows"] for segment in self.segments)
+        size = sum(segment["bytes"] for segment in self.segments)
+        waits = f" including {format_duration(self.waits)} of waits" if self.waits else ""
+        print(f"Dry run of {len(self.segments)} measurements: {format_duration(self.elapsed)}{waits}, "
+              f"{rows} rows, {size/1e6:.1f} MB")
+        for segment in self.segments:
+            notes = f" ({', '.join(sorted(set(segment['notes'])))})" if segment["notes"] else ""
+            print(f"  {segment['title']} -> {segment['filename']}: {segment['setpoints']} setpoints, "
+                  f"{format_duration(segment['seconds'])}, {segment['rows']} rows, "
+                  f"{segment['bytes']/1e6:.1f} MB{notes}")
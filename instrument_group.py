@@ -1,30 +1,247 @@
-from time import ctime, time, sleep
+from time import time, ctime, perf_counter, monotonic, sleep
 import numpy as np
 import pyvisa
 import os
 import csv
-import io
+import gzip
+import asyncio
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from acquisition import AcquisitionEngine, Step, RampTCondition, RampBCondition, HeaterSweepCondition, CheckpointJournal
+from sweep import Sweep, format_duration
+from dryrun import LatencyModel, SimulatedResource, DryRun
+from analysis import RunningStats, RunningFit, StreamAnalysis, GridBinner
+from cryostat import OwnerFinishedCondition
+
+class FileSink:
+    """Writes rows to a file.
+
+    If position is given, the existing file is cut at that position and 
+    appended to, for resuming a measurement.
+    """
+    def __init__(self, filename, position=None):
+        if position is None:
+            self.file = open(filename, 'w', newline='')
+        else:
+            os.truncate(filename, position)
+            self.file = open(filename, 'a', newline='')
+
+    def write(self, text):
+        return self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+    def checkpoint(self):
+        """Writes everything to disk and returns the position in the file"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+class CompressedFileSink:
+    """Writes rows to a gzip file in independently compressed chunks.
+
+    Rows are buffered and compressed as a separate gzip member every 
+    chunk_rows rows or chunk_seconds seconds, whichever comes first. A crash
+    only loses the rows in the current chunk, and the file can be read as a 
+    stream with gzip.open or pandas.read_csv.
+    """
+    def __init__(self, filename, chunk_rows=1000, chunk_seconds=60, compresslevel=6, position=None):
+        if position is None:
+            self.file = open(filename, 'wb')
+        else:
+            os.truncate(filename, position)
+            self.file = open(filename, 'ab')
+        self.chunk_rows = chunk_rows
+        self.chunk_seconds = chunk_seconds
+        self.compresslevel = compresslevel
+        self.buffer = []
+        self.chunk_start = time()
+
+    def write(self, text):
+        self.buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        # called after every row, only write once the chunk is full
+        if (len(self.buffer) >= self.chunk_rows) or (time()-self.chunk_start > self.chunk_seconds):
+            self.write_chunk()
+
+    def write_chunk(self):
+        if self.buffer:
+            data = "".join(self.buffer).encode()
+            self.file.write(gzip.compress(data, compresslevel=self.compresslevel))
+            self.file.flush()
+            self.buffer = []
+        self.chunk_start = time()
+
+    def checkpoint(self):
+        """Writes the current chunk to disk and returns the position in the file"""
+        self.write_chunk()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.write_chunk()
+        self.file.close()
+
+class NullSink:
+    """Discards every row."""
+    rows = ()
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def checkpoint(self):
+        return 0
+
+    def close(self):
+        pass
+
+class RingBufferSink:
+    """Keeps the last maxlen rows in memory for inspection.
+
+    Rows are kept after closing, so the same sink can be reused across 
+    several measurements and still holds the most recent rows.
+    """
+    def __init__(self, maxlen=1000):
+        self.rows = deque(maxlen=maxlen)
+
+    def write(self, text):
+        # csv.writer writes one complete row per call
+        self.rows.extend(text.splitlines())
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def checkpoint(self):
+        return 0
+
+    def close(self):
+        pass
 
 class ConditionalFileWriter:
-    def __init__(self, filename, should_write):
-        name,extension = os.path.splitext(filename)
-        i=1
-        while os.path.isfile(filename):
-            filename = name + "_" + str(i) + extension
-            i+=1
+    def __init__(self, filename, should_write, sink=None, compress=False, position=None):
+        if compress and not filename.endswith(".gz"):
+            filename += ".gz"
+        # position is given when resuming, the existing file is appended to
+        if position is None:
+            name,extension = os.path.splitext(filename)
+            i=1
+            while os.path.isfile(filename):
+                filename = name + "_" + str(i) + extension
+                i+=1
         self.filename = filename
         self.should_write = should_write
+        # sink receives the rows when not writing to file
+        self.sink = sink
+        self.compress = compress
+        self.position = position
 
     def __enter__(self):
-        if self.should_write:
-            self.file = open(self.filename, 'w', newline='')
+        if self.should_write and self.compress:
+            self.file = CompressedFileSink(self.filename, position=self.position)
+        elif self.should_write:
+            self.file = FileSink(self.filename, position=self.position)
+        elif self.sink is not None:
+            self.file = self.sink
         else:
-            self.file = io.StringIO()
+            self.file = NullSink()
         return self.file
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.file.close()
 
+class Channel:
+    """A named column of the data file.
+
+    Channels with a getter are read by calling it once per row, channels 
+    sharing a getter use one call, with index selecting the element of the
+    returned tuple. Channels without a getter are filled in by 
+    InstrumentGroup.read_everything. Channels with group None, like Time and
+    the resistances, have no timestamp column.
+    """
+    def __init__(self, name, units=None, getter=None, instrument=None, index=None, group=None):
+        self.name = name
+        self.units = units
+        self.getter = getter
+        self.instrument = instrument
+        self.index = index
+        # channels in the same group share one timestamp column
+        self.group = group
+        self.enabled = True
+
+    @property
+    def header(self):
+        if self.units:
+            return f"{self.name} ({self.units})"
+        return self.name
+
+def open_data_file(filename):
+    """Opens a measurement file for reading as text, compressed or not."""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, 'rt', newline='')
+    return open(filename, 'r', newline='')
+
+class Row:
+    """The values of one row while it is being read.
+
+    Works out which instruments are needed for the enabled channels of the
+    InstrumentGroup, and collects the values and timestamps as they are read.
+    """
+    def __init__(self, group, time0=0):
+        self.group = group
+        self.time0 = time0
+        self.channels = group.get_channels()
+        names = set(channel.name for channel in self.channels)
+        # only the instruments needed for the enabled channels are read
+        self.Rs = [(Iname,Vname) for Iname,_ in group.sourcemeters for Vname,_ in group.voltmeters
+                   if f"R_{Iname}{Vname}" in names]
+        self.sourcemeters = [(name,sourcemeter) for name,sourcemeter in group.sourcemeters
+                             if f"I_{name}" in names or name in [Iname for Iname,_ in self.Rs]]
+        self.voltmeters = [(name,voltmeter) for name,voltmeter in group.voltmeters
+                           if {f"V+_{name}",f"V-_{name}"} & names or name in [Vname for _,Vname in self.Rs]]
+        self.reverse = bool(self.Rs) or any(f"V-_{name}" in names for name,_ in self.voltmeters)
+        self.lakeshore = bool(group.lakeshore and {"T_sample","T_sample_err"} & names)
+        self.values = {"Time": round(group.now()-time0,2)}
+        self.Is = {}
+        self.Vps = {}
+        self.Vns = {}
+        self.lakeshoreT = []
+        self.start_Vp = None
+        # first and last time each group was read
+        self.stamps = {}
+
+    def clock(self):
+        return self.group.clock(self.time0)
+
+    def stamp(self, group, start):
+        end = self.clock()
+        if group in self.stamps:
+            self.stamps[group][1] = end
+        else:
+            self.stamps[group] = [start,end]
+
+    def get_data(self):
+        """Returns the row as a list in the order of the headers"""
+        data = [self.values[channel.name] for channel in self.channels]
+        if self.group.timestamps:
+            for group in self.group.get_timestamp_groups():
+                if group in self.stamps:
+                    data.append(round(np.mean(self.stamps[group]),4))
+                else:
+                    data.append(np.nan)
+        return data
+
 class InstrumentGroup():
     """A class for controlling a group of instruments and recording data."""
     def __init__(self, **kwargs):
@@ -53,6 +270,31 @@ class InstrumentGroup():
         lakeshore: Lakeshore object
             An instance of the Lakeshore class, for additional temperature 
             measurement.
+        retries : int
+            The number of times a failed read is retried before the channel 
+            is recorded as NaN. Default is 1.
+        retry_delay : float
+            The time to wait before the first retry in seconds, doubling for
+            each further retry. Default is 0.05.
+        quarantine_after : int
+            The number of failed reads in a row after which an instrument is
+            skipped, recording NaN for its channels. Default is 3.
+        quarantine_time : float
+            The time in seconds for which a failing instrument is skipped 
+            before trying it again. Default is 60.
+        timestamps : bool
+            If True, a timestamp column "t_<group> (s)" is added at the end of
+            each row for every channel group (iTC, iPS, I, V+, V-, ...). It 
+            is the midpoint of the reads of that group, in seconds on the 
+            same scale as Time but from a monotonic high resolution clock.
+            Default is False.
+        compress : bool
+            If True, data files are written gzip compressed with a .gz 
+            extension. Default is False.
+        cryostat : Cryostat object
+            The iTC and iPS shared with other InstrumentGroups measuring 
+            other samples, used instead of iTC and iPS, e.g. 
+            cryostat.Cryostat(iTC,iPS). See follow_cryostat.
         
         Returns
         -------
@@ -61,12 +303,42 @@ class InstrumentGroup():
         self.voltmeters = kwargs.get("voltmeters", [])
         self.sourcemeters = kwargs.get("sourcemeters", [])
         self.Vsourcemeters = kwargs.get("Vsourcemeters", [])
-        self.iTC = kwargs.get("iTC", None)
-        self.iPS = kwargs.get("iPS", None)
+        self.cryostat = kwargs.get("cryostat", None)
+        if self.cryostat is not None:
+            self.iTC = self.cryostat.iTC
+            self.iPS = self.cryostat.iPS
+        else:
+            self.iTC = kwargs.get("iTC", None)
+            self.iPS = kwargs.get("iPS", None)
         self.lakeshore = kwargs.get("lakeshore", None)
         self.comment = kwargs.get("comment", " ")
         self.filename = kwargs.get("filename", "You_forgot_to_set_a_filename.txt")
         self.measure = kwargs.get("measure", True)
+        self.compress = kwargs.get("compress", False)
+        self.timestamps = kwargs.get("timestamps", False)
+        self.retries = kwargs.get("retries", 1)
+        self.retry_delay = kwargs.get("retry_delay", 0.05)
+        self.quarantine_after = kwargs.get("quarantine_after", 3)
+        self.quarantine_time = kwargs.get("quarantine_time", 60)
+        # the last or running measurement, see start_job
+        self.job = None
+        self.journal = None
+        # set while a script is run with dry_run
+        self.dry = None
+        # recorded measurement replayed by the instruments, see replay.replay_group
+        self.trace = None
+        # running statistics and fits of the rows, see add_statistics and add_fit
+        self.analysis = StreamAnalysis()
+        # averages of the rows on a grid, see set_binning
+        self.binning = None
+        self.background = False
+        # monotonic clock aligned with time() when the group was created
+        self.wall0 = time()
+        self.perf0 = perf_counter()
+        self.unrecorded_sink = NullSink()
+        self.channels = self.build_channels()
+        # the names given to select_channels, None while every channel is enabled
+        self.selection = None
 
     def set_filename(self,filename):
         self.filename = filename
@@ -74,35 +346,306 @@ class InstrumentGroup():
     
     def set_comment(self,comment):
         self.comment = comment
+
+    def set_compression(self,compress=True):
+        self.compress = compress
+
+    def set_timestamps(self,timestamps=True):
+        self.timestamps = timestamps
+
+    def file_writer(self,filename=None,position=None):
+        """Returns a ConditionalFileWriter for the current filename, or for 
+        appending to filename from position when resuming"""
+        should_write = self.measure and (self.binning is None or self.binning.raw)
+        return ConditionalFileWriter(filename or self.filename,should_write,self.unrecorded_sink,
+                                     self.compress,position)
+
+    def set_binning(self,x,step,columns=None,raw=True):
+        """Averages the rows of every following measurement onto a uniform 
+        grid, written to a binned file at the end of each measurement.
+
+        The binned file is named after the data file with _binned added, 
+        e.g. data_binned.csv, and has the same header. Its columns are the 
+        grid point, the number of rows in the bin, and the mean and standard
+        error of each channel.
+
+        Parameters
+        ----------
+        x : str
+            The channel to bin on, e.g. "B", "T_probe" or "Vg_A".
+        step : float
+            The grid spacing, the grid points are multiples of step.
+        columns : list of str, optional
+            The channels to average. Default is every channel except Time.
+        raw : bool, optional
+            If False, only the binned file is written, not every row. 
+            Default is True.
+        """
+        self.check_columns(x,*(columns or []))
+        self.binning = GridBinner(x,step,columns,raw)
+
+    def clear_binning(self):
+        self.binning = None
+
+    def write_binned(self,title,filename):
+        """Writes the binned rows of the last measurement next to filename"""
+        if not self.measure:
+            return
+        name,extension = os.path.splitext(filename.removesuffix(".gz"))
+        units = {channel.name:channel.units for channel in self.channels}
+        binned_writer = ConditionalFileWriter(f"{name}_binned{extension}",True,compress=self.compress)
+        with binned_writer as f:
+            writer = csv.writer(f)
+            writer.writerows([[str(ctime())],[f"{title} binned on {self.binning.x} every {self.binning.step}"],
+                              [self.comment],["[DATA]"]])
+            writer.writerows([self.binning.headers(units)])
+            writer.writerows(self.binning.rows())
+        print(f"Wrote {len(self.binning.bins)} bins to {binned_writer.filename}")
+
+    def set_checkpoint(self,filename,interval=60):
+        """Records the progress of every following measurement in a journal.
+
+        If the script stops partway, e.g. because of an error, run it again 
+        from the top with the same journal. Completed measurements are skipped
+        and a partly completed one resumes at its next unfinished setpoint, 
+        appending to the same data file. Measurements are matched by their 
+        order in the script, type and filename, so don't change the script 
+        before the point where it stopped. Instrument settings from skipped 
+        measurements, e.g. the gate voltage, are assumed to be unchanged.
+
+        Parameters
+        ----------
+        filename : str
+            The journal file, e.g. folder+"my_sample_checkpoint.jsonl".
+        interval : float, optional
+            The minimum time between checkpoints in seconds. Each checkpoint
+            syncs the data file to disk and, for compressed files, ends a 
+            compressed chunk, so checkpointing every row of a long sweep is
+            slow. Setpoints since the last checkpoint are measured again on
+            resuming. Default is 60.
+        """
+        self.journal = CheckpointJournal(filename,interval)
+
+    def clear_checkpoint(self):
+        self.journal = None
     
-    def dont_measure(self):
+    def dont_measure(self,keep_rows=0):
+        """Stops writing data to file until the next set_filename.
+        
+        Rows are discarded, unless keep_rows is given, in which case the last 
+        keep_rows rows are kept in memory in IG.unrecorded_sink.rows.
+        """
         self.measure = False
+        if keep_rows:
+            self.unrecorded_sink = RingBufferSink(keep_rows)
+        else:
+            self.unrecorded_sink = NullSink()
 
-    def get_headers(self):
-        """Returns a list of headers for the data file"""
-        headers = ["Time"]
+    def get_instruments(self):
+        """Returns a list of every instrument in the group"""
+        instruments = [instrument for _,instrument in 
+                       self.voltmeters + self.sourcemeters + self.Vsourcemeters]
+        instruments += [instrument for instrument in (self.iTC,self.iPS,self.lakeshore)
+                        if instrument]
+        return instruments
+
+    def reconcile(self):
+        """Reads back every mirrored setpoint from the instruments.
+        
+        Instruments created with mirror=True answer setpoint getters from the
+        values last written by this process. This checks those values against
+        the hardware, e.g. after changes on the front panel.
+
+        Returns
+        -------
+        dict
+            The changed values for each instrument address, as (mirrored, 
+            actual) tuples.
+        """
+        changed = {}
+        for instrument in self.get_instruments():
+            instrument_changed = instrument.reconcile()
+            if instrument_changed:
+                changed[instrument.GPIB_address] = instrument_changed
+        return changed
+
+    def build_channels(self):
+        """Returns the default list of channels for the instruments in the group"""
+        channels = [Channel("Time")]
         if self.iTC:
-            headers += ["T_probe (K)", "T_probe_setpoint (K)", "T_probe_ramp_rate (K/min)", 
-                        "heater_probe (%)", "T_VTI (K)", "T_VTI_setpoint (K)", "T_VTI_ramp_rate (K/min)", 
-                        "heater_VTI (%)","Pressure (mB)","Needlevalve"]
+            channels += [Channel("T_probe","K",self.iTC.get_probe_temp,self.iTC,group="iTC"),
+                         Channel("T_probe_setpoint","K",self.iTC.get_probe_setpoint,self.iTC,group="iTC"),
+                         Channel("T_probe_ramp_rate","K/min",self.iTC.get_probe_ramp_rate,self.iTC,group="iTC"),
+                         Channel("heater_probe","%",self.iTC.get_probe_heater,self.iTC,group="iTC"),
+                         Channel("T_VTI","K",self.iTC.get_VTI_temp,self.iTC,group="iTC"),
+                         Channel("T_VTI_setpoint","K",self.iTC.get_VTI_setpoint,self.iTC,group="iTC"),
+                         Channel("T_VTI_ramp_rate","K/min",self.iTC.get_VTI_ramp_rate,self.iTC,group="iTC"),
+                         Channel("heater_VTI","%",self.iTC.get_VTI_heater,self.iTC,group="iTC"),
+                         Channel("Pressure","mB",self.iTC.get_pressure,self.iTC,group="iTC"),
+                         Channel("Needlevalve",None,self.iTC.get_needlevalve,self.iTC,group="iTC")]
         if self.iPS:
-            headers += ["B (T)", "B_setpoint (T)", "B_ramp_rate (T/min)"]
+            channels += [Channel("B","T",self.iPS.get_field,self.iPS,group="iPS"),
+                         Channel("B_setpoint","T",self.iPS.get_field_setpoint,self.iPS,group="iPS"),
+                         Channel("B_ramp_rate","T/min",self.iPS.get_field_sweep_rate,self.iPS,group="iPS")]
+        # channels without a getter are filled in by the current reversal in read_everything
+        if self.cryostat is not None:
+            # the iTC and iPS are read through the cryostat, so only its owner queries them
+            for channel in channels:
+                if channel.getter is not None:
+                    channel.getter = partial(self.cryostat.read,self,channel.name,channel.getter)
         for name,sourcemeter in self.sourcemeters:
-            headers.append(f"I_{name} (A)")
+            channels.append(Channel(f"I_{name}","A",instrument=sourcemeter,group="I"))
         for name,Vsourcemeter in self.Vsourcemeters:
-            headers.append(f"Vg_{name} (V)")
-            headers.append(f"Ileak_{name} (A)")
+            channels.append(Channel(f"Vg_{name}","V",Vsourcemeter.get_voltage_and_Ileak,Vsourcemeter,index=0,group=f"Vg_{name}"))
+            channels.append(Channel(f"Ileak_{name}","A",Vsourcemeter.get_voltage_and_Ileak,Vsourcemeter,index=1,group=f"Vg_{name}"))
         for name,voltmeter in self.voltmeters:
-            headers.append(f"V+_{name} (V)")
+            channels.append(Channel(f"V+_{name}","V",instrument=voltmeter,group="V+"))
         for name,voltmeter in self.voltmeters:
-            headers.append(f"V-_{name} (V)")
+            channels.append(Channel(f"V-_{name}","V",instrument=voltmeter,group="V-"))
         for Iname,sourcemeter in self.sourcemeters:
             for Vname,voltmeter in self.voltmeters:
-                headers.append(f"R_{Iname}{Vname} (ohm)")
+                channels.append(Channel(f"R_{Iname}{Vname}","ohm"))
         if self.lakeshore:
-            headers += ["T_sample (K)"]
-            headers += ["T_sample_err (K)"]
+            channels += [Channel("T_sample","K",instrument=self.lakeshore,group="T_sample"),
+                         Channel("T_sample_err","K",instrument=self.lakeshore,group="T_sample")]
+        return channels
+
+    def add_channel(self,name,units,getter,instrument=None,group=None):
+        """Adds a channel which is read by calling getter once per row.
+        
+        Parameters
+        ----------
+        name : str
+            The name of the channel, used in the header with the units.
+        units : str or None
+            The units of the channel.
+        getter : callable
+            A function with no arguments which returns the value.
+        instrument : Instrument object, optional
+            The instrument the getter communicates with.
+        group : str, optional
+            The timestamp group of the channel. Default is the channel name.
+
+        If channels were selected with select_channels, the new channel is 
+        only read once it is selected too.
+        """
+        if name in [channel.name for channel in self.channels]:
+            raise ValueError(f"Channel {name} already exists")
+        channel = Channel(name,units,getter,instrument,group=group or name)
+        channel.enabled = self.selection is None
+        self.channels.append(channel)
+
+    def select_channels(self,*names):
+        """Only read and write the named channels, in addition to Time.
+
+        Channels are named as in the header without the units, e.g. 
+        IG.select_channels("T_probe","R_AA") for a fast IV. Calling with no
+        names enables every channel again.
+        """
+        self.check_columns(*names)
+        self.selection = names or None
+        for channel in self.channels:
+            channel.enabled = (not names) or (channel.name in names) or (channel.name == "Time")
+
+    def add_statistics(self,name,column,window=None,per_setpoint=False):
+        """Keeps running statistics of a column while measuring.
+
+        The count, mean, standard deviation, standard error, minimum and 
+        maximum are updated with every row, without reading the file. See 
+        get_analysis.
+
+        Parameters
+        ----------
+        name : str
+            The name of the result, e.g. "R_mean".
+        column : str
+            The channel name, e.g. "R_AA".
+        window : int, optional
+            Only include the last window rows. Default is all rows of the 
+            measurement.
+        per_setpoint : bool, optional
+            If True, restart at every setpoint and keep the result of each 
+            setpoint in IG.analysis.history, e.g. for averaging repeated 
+            points. Default is False.
+        """
+        self.check_columns(column)
+        self.analysis.add(name,RunningStats(column,window),per_setpoint)
+
+    def add_fit(self,name,x,y,window=None,per_setpoint=False):
+        """Keeps a running straight line fit of y against x while measuring.
+
+        The slope, intercept, slope error and r2 are updated with every row,
+        e.g. IG.add_fit("Hall","B","R_AB") for the Hall slope, or 
+        IG.add_fit("dRdT","T_probe","R_AA",window=100) for dR/dT over the 
+        last 100 rows. See get_analysis.
+
+        Parameters
+        ----------
+        name : str
+            The name of the result.
+        x, y : str
+            The channel names.
+        window : int, optional
+            Only fit the last window rows. Default is all rows of the 
+            measurement.
+        per_setpoint : bool, optional
+            If True, restart at every setpoint and keep the result of each 
+            setpoint in IG.analysis.history. Default is False.
+        """
+        self.check_columns(x,y)
+        self.analysis.add(name,RunningFit(x,y,window),per_setpoint)
+
+    def remove_analysis(self,name=None):
+        """Removes a statistic or fit, or all of them if name is None"""
+        self.analysis.remove(name)
+
+    def get_analysis(self):
+        """Returns the current results of the statistics and fits as a 
+        dictionary, also while a measurement runs in the background"""
+        return self.analysis.results()
+
+    def print_analysis(self):
+        for name,result in self.get_analysis().items():
+            print(f"{name}: " + ", ".join(f"{key} {value:.6g}" for key,value in result.items()))
+
+    def check_columns(self,*names):
+        known = [channel.name for channel in self.channels]
+        for name in names:
+            if name not in known:
+                raise ValueError(f"Unknown channel {name}, use one of {known}")
+
+    def get_channels(self):
+        """Returns a list of the enabled channels"""
+        return [channel for channel in self.channels if channel.enabled]
+
+    def get_timestamp_groups(self):
+        """Returns the groups of the enabled channels which get a timestamp"""
+        groups = []
+        for channel in self.get_channels():
+            if channel.group is not None and channel.group not in groups:
+                groups.append(channel.group)
+        return groups
+
+    def get_headers(self):
+        """Returns a list of headers for the data file"""
+        headers = [channel.header for channel in self.get_channels()]
+        if self.timestamps:
+            headers += [f"t_{group} (s)" for group in self.get_timestamp_groups()]
         return headers
+
+    def now(self):
+        """Returns the time used for the Time column and the ramp conditions,
+        the recorded time when replaying a trace"""
+        if self.trace is not None:
+            return self.trace.now()
+        return time()
+
+    def clock(self,time0=0):
+        """Returns a monotonic high resolution time on the same scale as 
+        now()-time0, the recorded time of the row when replaying a trace"""
+        if self.trace is not None:
+            return self.trace.now() - time0
+        return self.wall0 + (perf_counter()-self.perf0) - time0
     
     @staticmethod
     def round_to_significant_figures(num, sig_figs):
@@ -111,100 +654,197 @@ class InstrumentGroup():
         else:
             return 0  # Can't take the log of 0
     
+    def new_row(self,time0=0):
+        """Returns an empty Row for the enabled channels"""
+        if self.trace is not None:
+            self.trace.advance()
+        return Row(self,time0)
+
     def read_everything(self,time0=0):
-        """Collects data from all instruments and returns a list"""
-        Is = []
-        Vps = []
-        Vns = []
-        lakeshoreT=[]
-        data = [round(time()-time0,2)]
-        for name,voltmeter in self.voltmeters:
-            voltmeter.start_voltage_measurement()
-        if self.iTC:
-            data += [self.iTC.get_probe_temp(),
-                     self.iTC.get_probe_setpoint(),
-                     self.iTC.get_probe_ramp_rate(),
-                     self.iTC.get_probe_heater(),
-                     self.iTC.get_VTI_temp(),
-                     self.iTC.get_VTI_setpoint(),
-                     self.iTC.get_VTI_ramp_rate(),
-                     self.iTC.get_VTI_heater(),
-                     self.iTC.get_pressure(),
-                     self.iTC.get_needlevalve()]
-        if self.lakeshore:
-            lakeshoreT += [self.lakeshore.get_temp(),
-                           self.lakeshore.get_temp(),
-                           self.lakeshore.get_temp()]
-        if self.iPS:
-            data += [self.iPS.get_field(),
-                     self.iPS.get_field_setpoint(),
-                     self.iPS.get_field_sweep_rate()]
-        for name,sourcemeter in self.sourcemeters:
-            Is += [sourcemeter.get_current()]
-        data += Is
-        for name,Vsourcemeter in self.Vsourcemeters:
-            Vg,Ileak = Vsourcemeter.get_voltage_and_Ileak()
-            data += [Vg,Ileak]
-        for name,voltmeter in self.voltmeters:
-            Vps += [voltmeter.get_voltage_measurement()]
-        data += Vps
-        for name,sourcemeter in self.sourcemeters:
-            sourcemeter.reverse_current()
-        if self.lakeshore:
-            lakeshoreT += [self.lakeshore.get_temp(),
-                           self.lakeshore.get_temp(),
-                           self.lakeshore.get_temp()]
-        for name,voltmeter in self.voltmeters:
-            voltmeter.start_voltage_measurement()
-        for name,voltmeter in self.voltmeters:
-            Vns += [voltmeter.get_voltage_measurement()]
-        data += Vns
-        for I in Is:
-            for Vp,Vn in zip(Vps,Vns):
-                try:
-                    data += [self.round_to_significant_figures(0.5*(Vp-Vn)/I,9)]
-                except:
-                    data += [np.nan]
-        for name,sourcemeter in self.sourcemeters:
-            sourcemeter.reverse_current()
-        if self.lakeshore:
-            lakeshoreT += [self.lakeshore.get_temp(),
-                           self.lakeshore.get_temp(),
-                           self.lakeshore.get_temp()]
-            data += [round(np.mean(lakeshoreT),4)]
-            data += [round(np.ptp(lakeshoreT),4)]
-        return data
+        """Collects data from the enabled channels and returns a list"""
+        row = self.new_row(time0)
+        self.start_transport(row)
+        self.read_polled(row,row.channels)
+        self.finish_transport(row)
+        return row.get_data()
+
+    async def aread_everything(self,time0=0):
+        """Collects data from the enabled channels and returns a list.
+        
+        The polled channels of each instrument are read in an executor at the
+        same time as each other and as the current reversal measurement, so a
+        slow reply from one instrument doesn't hold up the others.
+        """
+        row = self.new_row(time0)
+        loop = asyncio.get_running_loop()
+        polled = {}
+        for channel in row.channels:
+            if channel.getter:
+                polled.setdefault(channel.instrument,[]).append(channel)
+        def transport():
+            self.start_transport(row)
+            self.finish_transport(row)
+        await asyncio.gather(loop.run_in_executor(None,transport),
+                             *[loop.run_in_executor(None,self.read_polled,row,channels)
+                               for channels in polled.values()])
+        return row.get_data()
+
+    @staticmethod
+    def hold_locks(instruments):
+        """Returns a context manager holding the locks of the instruments"""
+        stack = ExitStack()
+        for instrument in instruments:
+            if instrument is not None:
+                stack.enter_context(instrument.lock)
+        return stack
+
+    def guarded(self,instrument,function,*args,default=np.nan):
+        """Calls function, returning default if it fails.
+
+        Failed calls are retried self.retries times, waiting retry_delay 
+        seconds, doubling each time, after the instrument has been recovered.
+        After quarantine_after failed calls in a row the instrument is skipped
+        for quarantine_time seconds, so a bad instrument only costs a bounded 
+        time per row. Failed calls are counted in instrument.errors.
+        """
+        if instrument is not None and monotonic() < instrument.quarantined_until:
+            return default
+        for attempt in range(self.retries+1):
+            try:
+                result = function(*args)
+            except (pyvisa.VisaIOError, ValueError, IndexError) as err:
+                error = err
+                if instrument is not None:
+                    instrument.recover()
+                if attempt < self.retries:
+                    sleep(self.retry_delay*2**attempt)
+            else:
+                # only reads count as success, a meter can accept commands and still reply with garbage
+                if instrument is not None and result is not None:
+                    instrument.consecutive_errors = 0
+                return result
+        if instrument is not None:
+            instrument.errors += 1
+            instrument.consecutive_errors += 1
+            if instrument.consecutive_errors >= self.quarantine_after:
+                instrument.quarantined_until = monotonic() + self.quarantine_time
+                print(f"Skipping {instrument.GPIB_address} for {self.quarantine_time} s after "
+                      f"{instrument.consecutive_errors} failed reads: {error!r}")
+        return default
+
+    def get_errors(self):
+        """Returns the number of failed reads of each instrument"""
+        return {instrument.GPIB_address: instrument.errors for instrument in self.get_instruments()}
+
+    def read_polled(self,row,channels):
+        """Reads the channels which have a getter, failed reads are NaN"""
+        readings = {}
+        with self.hold_locks(set(channel.instrument for channel in channels)):
+            for channel in channels:
+                if channel.getter:
+                    # getters shared by several channels are only called once
+                    if channel.getter not in readings:
+                        start = row.clock()
+                        readings[channel.getter] = self.guarded(channel.instrument,channel.getter,default=None)
+                        row.stamp(channel.group,start)
+                    reading = readings[channel.getter]
+                    if reading is None:
+                        row.values[channel.name] = np.nan
+                    else:
+                        row.values[channel.name] = reading if channel.index is None else reading[channel.index]
+
+    def get_transport_instruments(self,row):
+        instruments = [sourcemeter for _,sourcemeter in self.sourcemeters]
+        instruments += [voltmeter for _,voltmeter in row.voltmeters]
+        if row.lakeshore:
+            instruments.append(self.lakeshore)
+        return instruments
+
+    def start_transport(self,row):
+        """Starts the V+ measurement of the voltmeters"""
+        row.start_Vp = row.clock()
+        with self.hold_locks(self.get_transport_instruments(row)):
+            for name,voltmeter in row.voltmeters:
+                self.guarded(voltmeter,voltmeter.start_voltage_measurement)
+
+    def read_lakeshore(self,row):
+        if row.lakeshore:
+            start = row.clock()
+            row.lakeshoreT += [self.guarded(self.lakeshore,self.lakeshore.get_temp),
+                               self.guarded(self.lakeshore,self.lakeshore.get_temp),
+                               self.guarded(self.lakeshore,self.lakeshore.get_temp)]
+            row.stamp("T_sample",start)
+
+    def finish_transport(self,row):
+        """Reads the currents, V+ and V- with the current reversed, and the
+        sample temperature, and calculates the resistances. Failed reads are
+        NaN, and the resistance is NaN if its current could not be reversed."""
+        with self.hold_locks(self.get_transport_instruments(row)):
+            self.read_lakeshore(row)
+            start = row.clock()
+            for name,sourcemeter in row.sourcemeters:
+                row.Is[name] = row.values[f"I_{name}"] = self.guarded(sourcemeter,sourcemeter.get_current)
+            row.stamp("I",start)
+            for name,voltmeter in row.voltmeters:
+                row.Vps[name] = row.values[f"V+_{name}"] = self.guarded(voltmeter,voltmeter.get_voltage_measurement)
+            row.stamp("V+",row.start_Vp)
+            if row.reverse:
+                # only currents which were reversed are reversed back
+                reversed_sourcemeters = []
+                for name,sourcemeter in self.sourcemeters:
+                    if self.guarded(sourcemeter,sourcemeter.reverse_current,default=False) is not False:
+                        reversed_sourcemeters.append((name,sourcemeter))
+                    elif name in row.Is:
+                        row.Is[name] = np.nan
+                self.read_lakeshore(row)
+                start_Vn = row.clock()
+                for name,voltmeter in row.voltmeters:
+                    self.guarded(voltmeter,voltmeter.start_voltage_measurement)
+                for name,voltmeter in row.voltmeters:
+                    row.Vns[name] = row.values[f"V-_{name}"] = self.guarded(voltmeter,voltmeter.get_voltage_measurement)
+                row.stamp("V-",start_Vn)
+                for Iname,Vname in row.Rs:
+                    try:
+                        row.values[f"R_{Iname}{Vname}"] = self.round_to_significant_figures(0.5*(row.Vps[Vname]-row.Vns[Vname])/row.Is[Iname],9)
+                    except:
+                        row.values[f"R_{Iname}{Vname}"] = np.nan
+                for name,sourcemeter in reversed_sourcemeters:
+                    self.guarded(sourcemeter,sourcemeter.reverse_current)
+            if row.lakeshore:
+                self.read_lakeshore(row)
+                row.values["T_sample"] = round(np.mean(row.lakeshoreT),4)
+                row.values["T_sample_err"] = round(np.ptp(row.lakeshoreT),4)
     
     def flush_and_reset(self):
-        """ Flush buffers for mercury controllers, reset current to positive value"""
-        for name,sourcemeter in self.sourcemeters:
-            sourcemeter.set_current(abs(sourcemeter.get_current(nanforcompliance=False)))
-        if self.iTC:
-            print("Flushing iTC buffer")
-            flushed=False
-            while not flushed:
-                try:
-                    self.iTC.timeout = 500
-                    self.iTC.query("")
-                except pyvisa.VisaIOError as err:
-                    if err.abbreviation=='VI_ERROR_TMO':
-                        flushed=True
-                        pass
-                    else:
-                        raise
-        if self.iPS:
-            print("Flushing iPS buffer")
-            flushed=False
-            while not flushed:
-                try:
-                    self.iPS.timeout = 500
-                    self.iPS.query("")
-                except pyvisa.VisaIOError as err:
-                    if err.abbreviation=='VI_ERROR_TMO':
-                        flushed=True
-                        pass
-                    else:
-                        raise
+        """ Flush buffers for mercury controllers, reset current to positive value
+        
+        The Mercury buffers are drained without waiting for a timeout and the
+        request/response stream is resynchronised with *IDN?. All instruments
+        are restored in parallel.
+        """
+        # failures are printed, so every instrument is restored and the error 
+        # which interrupted the measurement isn't hidden
+        def reset_current(name,sourcemeter):
+            try:
+                with sourcemeter.lock:
+                    sourcemeter.set_current(abs(sourcemeter.get_current(nanforcompliance=False)))
+            except Exception as err:
+                print(f"Could not reset current of sourcemeter {name}: {err!r}")
+        def flush(name,mercury):
+            print(f"Flushing {name} buffer")
+            try:
+                with mercury.lock:
+                    mercury.recover()
+            except Exception as err:
+                print(f"Could not flush {name}: {err!r}")
+        with ThreadPoolExecutor() as executor:
+            futures = [executor.submit(reset_current,name,sourcemeter) for name,sourcemeter in self.sourcemeters]
+            if self.iTC:
+                futures.append(executor.submit(flush,"iTC",self.iTC))
+            if self.iPS:
+                futures.append(executor.submit(flush,"iPS",self.iPS))
+            for future in futures:
+                future.result()
 
     def print_current_vals(self):
         """Make one measurement from every instrument and print the values"""
@@ -218,6 +858,186 @@ class InstrumentGroup():
             print(f"Magnet T: {self.iPS.get_magnet_T()} K")
         return
     
+    def run(self,engine):
+        """Runs an AcquisitionEngine measurement and waits for it to finish.
+
+        If the user interrupts with Ctrl+C, the measurement is stopped and the
+        instruments are flushed and reset before re-raising. When called from
+        start_job, the measurement is started and not waited for.
+        """
+        if self.dry is not None:
+            self.dry.run(engine)
+            return
+        if self.busy():
+            raise RuntimeError("A background measurement is running, stop it with IG.job.stop()")
+        if self.journal is not None:
+            engine.journal = self.journal
+            engine.checkpoint = self.journal.next(engine.title,self.filename)
+            if engine.checkpoint["finished"]:
+                print(f"Skipping {engine.title}, already completed in {engine.checkpoint['filename']}")
+                return
+        if engine.controls_cryostat:
+            # claimed only once the measurement starts, the engine releases it when it ends
+            self.claim_cryostat()
+        self.job = engine
+        if self.background:
+            engine.start()
+            return
+        try:
+            engine.start()
+            engine.wait()
+        except KeyboardInterrupt:
+            print("User interrupted measurement")
+            self.flush_and_reset()
+            raise
+
+    def calibrate_latency(self,rows=5):
+        """Times the commands of a few rows and returns a LatencyModel for 
+        dry_run. Nothing is changed on the instruments.
+
+        The model can be saved with model.save(filename) and loaded later 
+        with LatencyModel.load(filename), to plan measurements when the 
+        instruments are busy or not connected.
+        """
+        return LatencyModel.calibrate(self,rows)
+
+    @contextmanager
+    def dry_run(self,model=None):
+        """Runs the measurements of a script without the instruments and 
+        reports how long they would take.
+
+        Inside the with block the instruments are replaced by simulated ones
+        answering with the setpoints they are sent, measurements and IG.sleep
+        run without waiting, and no files are written. When the block ends the estimated
+        duration, number of rows and file size of each measurement are 
+        printed.
+
+        Parameters
+        ----------
+        model : LatencyModel, optional
+            The command times, from calibrate_latency or LatencyModel.load. 
+            By default one is calibrated now.
+
+        Example
+        -------
+        with IG.dry_run(model) as dry:
+            IG.set_Vg(0)
+            IG.sleep(1800)
+            IG.ramp_B([12,-12],rates=0.3)
+        dry.segments
+        """
+        if model is None:
+            model = self.calibrate_latency()
+        instruments = self.get_instruments()
+        resources = [instrument.instr for instrument in instruments]
+        mirrors = [instrument.mirror for instrument in instruments]
+        self.dry = DryRun(self,model)
+        for instrument in instruments:
+            instrument.instr = SimulatedResource(model,instrument.GPIB_address,type(instrument).__name__,self.dry)
+            if instrument.mirror is not None:
+                instrument.mirror = {}
+        try:
+            yield self.dry
+        finally:
+            for instrument,resource,mirror in zip(instruments,resources,mirrors):
+                instrument.instr = resource
+                instrument.mirror = mirror
+            dry = self.dry
+            self.dry = None
+            dry.print_report()
+
+    def sleep(self,seconds):
+        """Waits between measurements of a script. 
+
+        Use this instead of time.sleep, so that in a dry_run the wait is 
+        added to the estimated duration instead of being slept.
+        """
+        if self.dry is not None:
+            self.dry.sleep(seconds)
+        else:
+            sleep(seconds)
+
+    def busy(self):
+        """Returns True while a measurement of the group is running"""
+        return self.job is not None and not self.job.done()
+
+    def claim_cryostat(self):
+        """Takes control of the shared cryostat for a measurement changing its
+        setpoints. Raises RuntimeError if another group is measuring with it."""
+        if self.cryostat is not None and self.dry is None:
+            self.cryostat.claim(self)
+
+    def release_cryostat(self):
+        if self.cryostat is not None:
+            self.cryostat.release(self)
+
+    def follow_cryostat(self,timeout_hours=18,grace=30):
+        """Measures continuously until the measurement of the group which 
+        controls the shared cryostat finishes.
+
+        The temperatures and field are the values read by the controlling 
+        group, the other channels are read by this group and written to its 
+        own file. Start the controlling measurement as a job first, e.g.
+
+        IG1.start_job(IG1.ramp_B,[12,-12],rates=0.3)
+        IG2.follow_cryostat()
+
+        Only measurements changing the temperature or field control the
+        cryostat, e.g. not set_Vg or perform_IV.
+
+        Parameters
+        ----------
+        timeout_hours : float, optional
+            The number of hours to measure for before stopping. Default is 18.
+        grace : float, optional
+            If no other group is measuring with the cryostat for this many
+            seconds, e.g. because its measurement already finished, following
+            stops. Default is 30.
+        """
+        if self.cryostat is None:
+            raise ValueError("The group has no shared cryostat")
+        steps = [Step(partial(OwnerFinishedCondition,self.cryostat,self,grace),timeout=timeout_hours*3600)]
+        self.run(AcquisitionEngine(self,"Follow cryostat",steps,message="Measuring during cryostat measurement"))
+        return
+
+    def start_job(self,mode,*args,**kwargs):
+        """Starts a measurement in the background and returns it.
+
+        The kernel stays free while the measurement runs, e.g. for plotting 
+        the data already written. Only one measurement can run at a time.
+
+        Parameters
+        ----------
+        mode : method
+            The measurement to run, e.g. IG.ramp_B.
+        *args, **kwargs
+            The arguments of the measurement.
+
+        Returns
+        -------
+        AcquisitionEngine
+            The running measurement, also stored as IG.job. Use 
+            job.print_progress() or job.progress() to follow it, 
+            job.recent_rows for the last rows, job.stop() to stop after the
+            current setpoint, or after the current row for single continuous
+            modes such as measure_until_interrupted, job.stop(now=True) to 
+            stop after the current row, and job.wait() to block until it finishes. None if the 
+            measurement did not start.
+
+        Example
+        -------
+        job = IG.start_job(IG.ramp_B,[12,-12,0],rates=0.3)
+        """
+        if self.busy():
+            raise RuntimeError("A background measurement is running, stop it with IG.job.stop()")
+        self.job = None
+        self.background = True
+        try:
+            mode(*args,**kwargs)
+        finally:
+            self.background = False
+        return self.job
+
     @staticmethod
     def make_list(x):
         """Converts a single value to a list, returns x as a list if it is 
@@ -246,35 +1066,9 @@ class InstrumentGroup():
         None
             Data is written to a file.
         """
-        try:
-            time0 = time()
-            timeout=timeout_hours*3600
-            with ConditionalFileWriter(self.filename,self.measure) as f:
-                if self.measure:
-                    print(f"Writing data to {self.filename}")
-                else:
-                    print("Not writing data to file")
-                print("Measuring continuously")
-                writer = csv.writer(f)
-                writer.writerows([[str(ctime())],["Continuous measurement"],[self.comment],["[DATA]"]])
-                headers = self.get_headers()
-                writer.writerows([headers])
-                measuring=True
-                while measuring:
-                    data = self.read_everything(time0=time0)
-                    writer.writerows([data])
-                    f.flush()
-                    sleep(0.01)
-
-                    if time()-time0 > timeout:
-                        measuring=False
-                        print("Timeout reached")
-                        break
-            return
-        except KeyboardInterrupt:
-            print("User interrupted measurement")
-            self.flush_and_reset()
-            raise
+        steps = [Step(timeout=timeout_hours*3600)]
+        self.run(AcquisitionEngine(self,"Continuous measurement",steps,message="Measuring continuously"))
+        return
     
     def ramp_T(self,controller,Ts,rates,threshold=0.05,base_T_threshold=0.001,timeout_hours=18):
         """Ramps the temperature and records data continuously to a file.
@@ -315,147 +1109,52 @@ class InstrumentGroup():
         None
             Data is written to a file.
         """
-        try:
-            with ConditionalFileWriter(self.filename,self.measure) as f:
-                if self.measure:
-                    print(f"Writing data to {self.filename}")
-                else:
-                    print("Not writing data to file")
-                writer = csv.writer(f)
-                writer.writerows([[str(ctime())],[f"Ramp {controller} T"],[self.comment],["[DATA]"]])
-                headers = self.get_headers()
-                writer.writerows([headers])
-
-                Ts = self.make_list(Ts)
-                rates = self.make_list(rates)
-                if len(rates)==1:
-                    rates=rates*len(Ts)
-                if len(Ts) != len(rates):
-                    print("Warning: length of T and rate lists are not equal")
-
-                for T,rate in zip(Ts,rates):
-                    if (rate==0) or (rate==np.nan) or (rate==np.inf):
-                        match controller:
-                            case "probe":
-                                self.iTC.set_probe_temp(T)
-                            case "VTI":
-                                self.iTC.set_VTI_temp(T)
-                            case "both":
-                                self.iTC.set_probe_temp(T)
-                                self.iTC.set_VTI_temp(T)
-                            case _:
-                                raise ValueError("Invalid controller, use 'probe', 'VTI', or 'both'")
-                        print(f"Setting {controller} to {T} K")
-                        min_time=60
-                    else:
-                        match controller:
-                            case "probe":
-                                min_time = 60*abs(T-self.iTC.get_probe_temp())/rate
-                                self.iTC.ramp_probe_temp(T,rate)
-                            case "VTI":
-                                min_time = 60*abs(T-self.iTC.get_VTI_temp())/rate
-                                self.iTC.ramp_VTI_temp(T,rate)
-                            case "both":
-                                min_time = max(60*abs(T-self.iTC.get_VTI_temp())/rate,60*abs(T-self.iTC.get_probe_temp())/rate)
-                                self.iTC.ramp_probe_temp(T,rate)
-                                self.iTC.ramp_VTI_temp(T,rate)
-                            case _:
-                                raise ValueError("Invalid controller. Use 'probe', 'VTI', or 'both'")
-                        print(f"Ramping {controller} to {T} K at {rate} K/min")
-                        
-
-                    time0 = time()
-                    timeout=timeout_hours*3600
-
-                    T_reached = 0
-                    T_stopped = 0
-                    T_diff_sign_change = 0
-
-                    prev_VTI_T=0
-                    prev_VTI_diff=0
-                    prev_probe_T=0
-                    prev_probe_diff=0
-
-                    time0=time()
-                    measuring = True
-                    while measuring:
-                        data = self.read_everything(time0=time0)
-                        writer.writerows([data])
-                        f.flush()
-                        sleep(0.01)
-
-                        probe_T = self.iTC.get_probe_temp()
-                        VTI_T = self.iTC.get_VTI_temp()
-                        probe_diff = probe_T - prev_probe_T
-                        VTI_diff = VTI_T - prev_VTI_T
-                        match controller:
-                            case "probe":
-                                if abs(probe_T-T) < threshold:
-                                    T_reached += 1
-                                else:
-                                    T_reached -= 10
-                                if abs(probe_diff) < base_T_threshold:
-                                    T_stopped += 1
-                                else:
-                                    T_stopped -= 10
-                                    if T_reached<0: # both conditions not met
-                                        T_diff_sign_change -= 5
-                                if probe_diff*prev_probe_diff<0:
-                                    T_diff_sign_change += 1
-                            case "VTI":
-                                if abs(VTI_T-T) < threshold:
-                                    T_reached += 1
-                                else:
-                                    T_reached = -10
-                                if abs(VTI_diff) < base_T_threshold:
-                                    T_stopped += 1
-                                else:
-                                    T_stopped -= 10
-                                    if T_reached<0: # both conditions not met
-                                        T_diff_sign_change -= 5
-                                if VTI_diff*prev_VTI_diff<0:
-                                    T_diff_sign_change += 1
-                            case "both":
-                                if (abs(probe_T-T) < threshold) and (abs(VTI_T-T) < threshold):
-                                    T_reached += 1
-                                else:
-                                    T_reached = -10
-                                if (abs(probe_diff) < base_T_threshold) and (abs(VTI_diff) < base_T_threshold):
-                                    T_stopped += 1
-                                else:
-                                    T_stopped -= 10
-                                    if T_reached<0: # both conditions not met
-                                        T_diff_sign_change -= 5
-                                if (probe_diff*prev_probe_diff<0) or (VTI_diff*prev_VTI_diff<0):
-                                    T_diff_sign_change += 1
-                        if T_reached<0:
-                            T_reached=0
-                        if T_stopped<0:
-                            T_stopped=0
-                        if T_diff_sign_change<0:
-                            T_diff_sign_change=0
-                        prev_probe_T = probe_T
-                        prev_VTI_T = VTI_T
-                        prev_probe_diff = probe_diff
-                        prev_VTI_diff = VTI_diff
-
-                        if (T_reached >= 30) and (T_diff_sign_change>=5) and (time()-time0 > min_time):
-                            measuring=False
-                            print(f"Finished ramping {controller} to {T} K")
-                            break
-                        if (T_stopped >= 50) and (T_diff_sign_change>=5) and (time()-time0 > min_time):
-                            measuring=False
-                            print(f"Reached base T in {controller} at {probe_T} K probe, {VTI_T} K VTI")
-                            break
-                        if time()-time0 > timeout:
-                            measuring=False
-                            print("Timeout reached")
-                            break
-            return
-        except KeyboardInterrupt:
-            print("User interrupted measurement")
-            self.flush_and_reset()
-            raise
+        if controller not in ("probe","VTI","both"):
+            raise ValueError("Invalid controller, use 'probe', 'VTI', or 'both'")
+        Ts = self.make_list(Ts)
+        rates = self.make_list(rates)
+        if len(rates)==1:
+            rates=rates*len(Ts)
+        if len(Ts) != len(rates):
+            print("Warning: length of T and rate lists are not equal")
+        steps = [Step(partial(self.apply_T,controller,T,rate,threshold,base_T_threshold),
+                      timeout=timeout_hours*3600,new_time0=True)
+                 for T,rate in zip(Ts,rates)]
+        self.run(AcquisitionEngine(self,f"Ramp {controller} T",steps,controls_cryostat=True))
+        return
+
+    def apply_T(self,controller,T,rate,threshold,base_T_threshold):
+        """Sets or starts ramping the temperature, returns the stop condition 
+        for ramp_T"""
+        if (rate==0) or (rate==np.nan) or (rate==np.inf):
+            match controller:
+                case "probe":
+                    self.iTC.set_probe_temp(T)
+                case "VTI":
+                    self.iTC.set_VTI_temp(T)
+                case "both":
+                    self.iTC.set_probe_temp(T)
+                    self.iTC.set_VTI_temp(T)
+                case _:
+                    raise ValueError("Invalid controller, use 'probe', 'VTI', or 'both'")
+            print(f"Setting {controller} to {T} K")
+            min_time=60
+        else:
+            match controller:
+                case "probe":
+                    min_time = 60*abs(T-self.iTC.get_probe_temp())/rate
+                    self.iTC.ramp_probe_temp(T,rate)
+                case "VTI":
+                    min_time = 60*abs(T-self.iTC.get_VTI_temp())/rate
+                    self.iTC.ramp_VTI_temp(T,rate)
+                case "both":
+                    min_time = max(60*abs(T-self.iTC.get_VTI_temp())/rate,60*abs(T-self.iTC.get_probe_temp())/rate)
+                    self.iTC.ramp_probe_temp(T,rate)
+                    self.iTC.ramp_VTI_temp(T,rate)
+                case _:
+                    raise ValueError("Invalid controller. Use 'probe', 'VTI', or 'both'")
+            print(f"Ramping {controller} to {T} K at {rate} K/min")
+        return RampTCondition(self.iTC,controller,T,threshold,base_T_threshold,min_time)
     
     def set_T(self,controller,T,**kwargs):
         """Sets the temperature and records data continuously to a file.
@@ -508,43 +1207,91 @@ class InstrumentGroup():
         None
             Data is written to a file.
         """
-        try:
-            probe_heater=self.make_list(probe_heater)
-            VTI_heater=self.make_list(VTI_heater)
-            if len(probe_heater)==1:
-                probe_heater = probe_heater*len(VTI_heater)
-            if len(VTI_heater)==1:
-                VTI_heater = VTI_heater*len(probe_heater)
-            if len(probe_heater)!=len(VTI_heater):
-                    print("WARNING: Probe and VTI heater lists area a different length")
-
-            with ConditionalFileWriter(self.filename,self.measure) as f:
-                if self.measure:
-                    print(f"Writing data to {self.filename}")
-                else:
-                    print("Not writing data to file")
-                print("Ramping heaters")
-                writer = csv.writer(f)
-                writer.writerows([[str(ctime())],[f"Set Vg"],[self.comment],["[DATA]"]])
-                headers = self.get_headers()
-                writer.writerows([headers])
-
-                time0=time()
-                for probe_heat,VTI_heat in zip(probe_heater,VTI_heater):
-                    self.iTC.set_probe_heater(probe_heat)
-                    self.iTC.set_VTI_heater(VTI_heat)
-                    sleep(wait)
-                    data = self.read_everything(time0=time0)
-                    writer.writerows([data])
-                    f.flush()
-                print(f"Finished ramping heaters")
-            return
-        except KeyboardInterrupt:
-            print("User interrupted measurement")
-            self.flush_and_reset()
-            raise
+        probe_heater=self.make_list(probe_heater)
+        VTI_heater=self.make_list(VTI_heater)
+        if len(probe_heater)==1:
+            probe_heater = probe_heater*len(VTI_heater)
+        if len(VTI_heater)==1:
+            VTI_heater = VTI_heater*len(probe_heater)
+        if len(probe_heater)!=len(VTI_heater):
+                print("WARNING: Probe and VTI heater lists area a different length")
+
+        steps = [Step(partial(self.apply_heater,probe_heat,VTI_heat),rows=1,wait=wait)
+                 for probe_heat,VTI_heat in zip(probe_heater,VTI_heater)]
+        self.run(AcquisitionEngine(self,"Set Vg",steps,message="Ramping heaters",
+                                   end_message="Finished ramping heaters",controls_cryostat=True))
+        return
 
+    def apply_heater(self,probe_heat,VTI_heat):
+        self.iTC.set_probe_heater(probe_heat)
+        self.iTC.set_VTI_heater(VTI_heat)
     
+    def sweep_heater(self,controller,T_end,rate=None,dT_per_row=None,heater=None,max_heater=100,
+                     gain=1,window=20,timeout_hours=18):
+        """Sweeps the temperature at a constant rate by adjusting the heater 
+        power, recording data continuously to a file.
+
+        Unlike ramp_heater, the heater power is not a fixed list: it is 
+        changed in a feedback loop on the measured dT/dt, so the sweep takes 
+        the requested time or has the requested temperature spacing of rows,
+        whatever the thermal response of the cryostat. The PID loop of the 
+        controller is turned off by setting the heater.
+
+        Parameters
+        ----------
+        controller : str
+            The heater to control, 'probe' or 'VTI'.
+        T_end : float
+            The temperature at which the sweep ends in K.
+        rate : float, optional
+            The target sweep rate in K/min.
+        dT_per_row : float, optional
+            The target temperature step between rows in K, instead of rate. 
+            The rate follows the measured time per row.
+        heater : float, optional
+            The starting heater power in %. Default is the present power.
+        max_heater : float, optional
+            The maximum heater power in %. Default is 100.
+        gain : float, optional
+            The change of heater power in % per K/min of rate error, made 
+            every window//2 rows. Default is 1.
+        window : int, optional
+            The number of rows over which dT/dt is fitted. Default is 20.
+        timeout_hours : float, optional
+            The number of hours before the sweep times out. Default is 18.
+
+        Returns
+        -------
+        None
+            Data is written to a file.
+        """
+        if controller not in ("probe","VTI"):
+            raise ValueError("Invalid controller, use 'probe' or 'VTI'")
+        if (rate is None) == (dT_per_row is None):
+            raise ValueError("Give either rate or dT_per_row")
+        steps = [Step(partial(self.apply_heater_sweep,controller,T_end,rate,dT_per_row,heater,
+                              max_heater,gain,window),timeout=timeout_hours*3600,new_time0=True)]
+        self.run(AcquisitionEngine(self,f"Sweep {controller} heater",steps,controls_cryostat=True))
+        return
+
+    def apply_heater_sweep(self,controller,T_end,rate,dT_per_row,heater,max_heater,gain,window):
+        """Sets the starting heater power, returns the feedback loop for 
+        sweep_heater"""
+        if controller == "probe":
+            T_start = self.iTC.get_probe_temp()
+            if heater is None:
+                heater = self.iTC.get_probe_heater()
+            self.iTC.set_probe_heater(heater)
+        else:
+            T_start = self.iTC.get_VTI_temp()
+            if heater is None:
+                heater = self.iTC.get_VTI_heater()
+            self.iTC.set_VTI_heater(heater)
+        target = f"{rate} K/min" if rate is not None else f"{dT_per_row} K per row"
+        print(f"Sweeping {controller} from {T_start} K to {T_end} K at {target}, heater starting at {heater} %")
+        return HeaterSweepCondition(self.iTC,controller,T_start,T_end,heater,rate,dT_per_row,
+                                    max_heater,gain,window)
+
     def ramp_B(self,Bs,rates,threshold=0.005,timeout_hours=18):
         """Ramps the magnetic field and records data continuously to a file.
 
@@ -576,62 +1323,32 @@ class InstrumentGroup():
         None
             Data is written to a file.
         """
-        try:
-            with ConditionalFileWriter(self.filename,self.measure) as f:
-                if self.measure:
-                    print(f"Writing data to {self.filename}")
-                else:
-                    print("Not writing data to file")
-                writer = csv.writer(f)
-                writer.writerows([[str(ctime())],[f"Ramp magnetic field"],[self.comment],["[DATA]"]])
-                headers = self.get_headers()
-                writer.writerows([headers])
-
-                Bs = self.make_list(Bs)
-                rates = self.make_list(rates)
-                if len(rates)==1:
-                    rates=rates*len(Bs)
-                if len(Bs) != len(rates):
-                    print("Warning: length of B and rate lists are not equal")
-
-                for B,rate in zip(Bs,rates):
-                    min_time = 60*abs(B-self.iPS.get_field())/rate
-                    self.iPS.set_field(B,rate)
-                    print(f"Ramping magnet to {B} T at {rate} T/min")
-
-                    time0 = time()
-                    timeout=timeout_hours*3600
-
-                    B_reached = 0
-                    measuring = True
-                    while measuring:
-                        data = self.read_everything(time0=time0)
-                        writer.writerows([data])
-                        f.flush()
-                        sleep(0.01)
-
-                        if abs(self.iPS.get_field()-B) < threshold:
-                            B_reached += 1
-                        else:
-                            B_reached = 0
-
-                        if (B_reached >= 10) and (time()-time0 > min_time):
-                            measuring=False
-                            print(f"Finished ramping magnet to {B} T")
-                            break
-                        if time()-time0 > timeout:
-                            measuring=False
-                            print("Timeout reached")
-                            break
-            return
-        except KeyboardInterrupt:
-            print("User interrupted measurement")
-            self.flush_and_reset()
-            raise
+        Bs = self.make_list(Bs)
+        rates = self.make_list(rates)
+        if len(rates)==1:
+            rates=rates*len(Bs)
+        if len(Bs) != len(rates):
+            print("Warning: length of B and rate lists are not equal")
+        steps = [Step(partial(self.apply_B,B,rate,threshold),timeout=timeout_hours*3600,new_time0=True)
+                 for B,rate in zip(Bs,rates)]
+        self.run(AcquisitionEngine(self,"Ramp magnetic field",steps,controls_cryostat=True))
+        return
+
+    def apply_B(self,B,rate,threshold):
+        """Starts ramping the field, returns the stop condition for ramp_B"""
+        min_time = 60*abs(B-self.iPS.get_field())/rate
+        self.iPS.set_field(B,rate)
+        print(f"Ramping magnet to {B} T at {rate} T/min")
+        return RampBCondition(self.iPS,B,threshold,min_time)
     
-    def reset_Vg(self):
+    def reset_Vg(self,full=False):
+        """Puts the Vsourcemeters in their default state with zero output.
+
+        Only settings which differ from the default are sent, unless full is 
+        True, in which case the Vsourcemeters receive *RST first.
+        """
         for _,Vsourcemeter in self.Vsourcemeters:
-            Vsourcemeter.reset()
+            Vsourcemeter.reset(full=full)
     
     def set_Vg(self,Vgs,compliance=5e-7,wait=0.1):
         """
@@ -661,38 +1378,22 @@ class InstrumentGroup():
         if any([Vg>250 for Vg in Vgs]):
             print("Gate setpoints exceed 250 V")
             return
-        try:
-            with ConditionalFileWriter(self.filename,self.measure) as f:
-                if self.measure:
-                    print(f"Writing data to {self.filename}")
-                else:
-                    print("Not writing data to file")
-                print("Setting gate voltages")
-                writer = csv.writer(f)
-                writer.writerows([[str(ctime())],[f"Set Vg"],[self.comment],["[DATA]"]])
-                headers = self.get_headers()
-                writer.writerows([headers])
-
-                for _,Vsourcemeter in self.Vsourcemeters:
-                    Vsourcemeter.set_compliance(compliance)
-                    Vsourcemeter.set_voltage(Vgs[0])
-                    Vsourcemeter.turn_on()
-
-                time0=time()
-                for Vg in Vgs:
-                    for _,Vsourcemeter in self.Vsourcemeters:
-                        Vsourcemeter.set_voltage(Vg)
-                        sleep(wait)
-                        data = self.read_everything(time0=time0)
-                        writer.writerows([data])
-                        f.flush()
-                print("Finished setting gate voltages")
-            return
-        except KeyboardInterrupt:
-            print("User interrupted measurement")
-            self.flush_and_reset()
-            raise
+        setpoints = [None]+Vgs
+        steps = [Step(partial(self.setup_Vg,Vgs[0],compliance),rows=0,new_time0=True,setup=True,
+                      resume=partial(self.resume_setup,self.setup_Vg,setpoints,compliance))]
+        steps += [Step(partial(self.apply_Vg,Vg),rows=1,wait=wait) for Vg in Vgs]
+        self.run(AcquisitionEngine(self,"Set Vg",steps,message="Setting gate voltages",
+                                   end_message="Finished setting gate voltages"))
+        return
+
+    def setup_Vg(self,Vg,compliance):
+        for _,Vsourcemeter in self.Vsourcemeters:
+            Vsourcemeter.setup(Vg,compliance)
 
+    def apply_Vg(self,Vg):
+        for _,Vsourcemeter in self.Vsourcemeters:
+            Vsourcemeter.set_voltage(Vg)
+    
     def set_current(self,I,compliance=5,on=[True]):
         """Sets the current without recording data.
 
@@ -726,12 +1427,7 @@ class InstrumentGroup():
         
         print(f"Setting current to {I}, compliance {compliance}")
         for i in range(len(self.sourcemeters)):
-            self.sourcemeters[i][1].set_compliance(compliance[i])
-            self.sourcemeters[i][1].set_current(I[i])
-            if on[i]:
-                self.sourcemeters[i][1].turn_on()
-            else:
-                self.sourcemeters[i][1].turn_off()
+            self.sourcemeters[i][1].setup(I[i],compliance[i],on[i])
     
     def perform_IV(self,Is,compliance=5,wait=0.01):
         """Changes the current, records one datapoint per setpoint to a file.
@@ -756,37 +1452,167 @@ class InstrumentGroup():
         None
             Data is written to a file.
         """
-        try:
-            with ConditionalFileWriter(self.filename,self.measure) as f:
-                if self.measure:
-                    print(f"Writing data to {self.filename}")
-                else:
-                    print("Not writing data to file")
-                print("Performing IV measurement")
-                writer = csv.writer(f)
-                writer.writerows([[str(ctime())],[f"Measure IV"],[self.comment],["[DATA]"]])
-                headers = self.get_headers()
-                writer.writerows([headers])
-                
-                for _,sourcemeter in self.sourcemeters:
-                    sourcemeter.set_compliance(compliance)
-                    sourcemeter.set_current(Is[0])
-                    sourcemeter.turn_on()
-                
-                time0=time()
-                for I in Is:
-                    if abs(I)<=1e-4:
-                        for _,sourcemeter in self.sourcemeters:
-                            sourcemeter.set_current(I)
-                        sleep(wait)
-                        data = self.read_everything(time0=time0)
-                        writer.writerows([data])
-                        f.flush()
-                    else:
-                        print(f"Current setpoint {I} A is larger than max 1e-4 A")
-                print("Finished IV measurement")
-            return
-        except KeyboardInterrupt:
-            print("User interrupted measurement")
-            self.flush_and_reset()
-            raise
\ No newline at end of file
+        Is = self.make_list(Is)
+        setpoints = [None]+[I if abs(I)<=1e-4 else None for I in Is]
+        steps = [Step(partial(self.setup_I,Is[0],compliance),rows=0,new_time0=True,setup=True,
+                      resume=partial(self.resume_setup,self.setup_I,setpoints,compliance))]
+        for I in Is:
+            if abs(I)<=1e-4:
+                steps.append(Step(partial(self.apply_I,I),rows=1,wait=wait))
+            else:
+                steps.append(Step(partial(print,f"Current setpoint {I} A is larger than max 1e-4 A"),rows=0))
+        self.run(AcquisitionEngine(self,"Measure IV",steps,message="Performing IV measurement",
+                                   end_message="Finished IV measurement"))
+        return
+
+    def setup_I(self,I,compliance):
+        for _,sourcemeter in self.sourcemeters:
+            sourcemeter.setup(I,compliance)
+
+    def resume_setup(self,setup,setpoints,compliance,first):
+        """Runs setup at the setpoint the measurement continues from.
+
+        setpoints has one entry per step of the measurement, None for steps
+        which don't set this quantity. If the first unfinished step sets it,
+        that value is used, otherwise the last value applied before it, e.g.
+        when resuming a field ramp inside a gate voltage block of a sweep. 
+        Before any setpoint was applied the first one is used.
+        """
+        if first < len(setpoints) and setpoints[first] is not None:
+            value = setpoints[first]
+        else:
+            earlier = [value for value in setpoints[:first] if value is not None]
+            later = [value for value in setpoints[first:] if value is not None]
+            value = earlier[-1] if earlier else later[0]
+        setup(value,compliance)
+
+    def apply_I(self,I):
+        for _,sourcemeter in self.sourcemeters:
+            sourcemeter.set_current(I)
+
+    def sweep(self,*axes,Vg_compliance=5e-7,I_compliance=5,T_threshold=0.05,base_T_threshold=0.001,
+              B_threshold=0.005,timeout_hours=18,nearest=True,row_time=None,estimate_only=False):
+        """Sweeps several quantities in nested loops and records to one file.
+
+        The first axis is the outermost. Stepped axes (Vg, I, heaters) record
+        one row per value on the innermost axis and no rows on outer axes. 
+        Ramped axes (T, B) record continuously until the setpoint is reached,
+        with the same stop conditions as ramp_T and ramp_B. Snake axes change
+        direction every time an outer axis moves, so e.g. a field sweep at 
+        each gate voltage goes 0 -> 12 T at the first and 12 -> 0 T at the 
+        second, instead of ramping back to 0 T. The estimated run time is 
+        printed before starting.
+
+        Parameters
+        ----------
+        *axes : Axis
+            The axes of the sweep, outermost first, e.g. 
+            Axis("Vg",[0,10,20]), Axis("B",np.linspace(0,12,5),rate=0.3), 
+            with from sweep import Axis.
+        Vg_compliance : float, optional
+            The compliance current of the Vsourcemeters in A. Default is 5e-7.
+        I_compliance : float, optional
+            The compliance of the sourcemeters. Default is 5.
+        T_threshold, base_T_threshold : float, optional
+            See ramp_T.
+        B_threshold : float, optional
+            See ramp_B.
+        timeout_hours : float, optional
+            The timeout of each ramp. Default is 18.
+        nearest : bool, optional
+            If True, ramped axes start from the end nearest to the present 
+            temperature or field. Default is True.
+        row_time : float, optional
+            The time to read one row in seconds, for the run time estimate. 
+            By default one row is read and timed, or in a dry_run the
+            row time of its LatencyModel is used.
+        estimate_only : bool, optional
+            If True, only print the estimate. Default is False.
+
+        Returns
+        -------
+        float
+            The estimated run time in seconds. Data is written to a file.
+        """
+        sweep = Sweep(axes)
+        for axis in sweep.axes:
+            if axis.name == "Vg" and any([Vg>250 for Vg in axis.values]):
+                raise ValueError("Gate setpoints exceed 250 V")
+            if axis.name == "I" and any([abs(I)>1e-4 for I in axis.values]):
+                raise ValueError("Current setpoints are larger than max 1e-4 A")
+            if axis.name in ("probe_heater","VTI_heater","probe_T","VTI_T","T") and not self.iTC:
+                raise ValueError(f"Sweeping {axis.name} needs an iTC")
+            if axis.name == "B" and not self.iPS:
+                raise ValueError("Sweeping B needs an iPS")
+        current = self.get_sweep_values(sweep)
+        if nearest:
+            sweep.start_nearest(current)
+        if row_time is None and self.dry is not None:
+            # simulated reads are near instant, use the calibrated row time
+            row_time = self.dry.model.row_time
+        elif row_time is None:
+            start = perf_counter()
+            self.read_everything()
+            row_time = perf_counter()-start
+        seconds,rows = sweep.estimate(row_time,current)
+        print(f"Sweep of {sweep.points()} points, estimated run time {format_duration(seconds)}, "
+              f"about {rows} rows")
+        raster,_ = sweep.estimate(row_time,current,snake=False)
+        if raster > seconds:
+            print(f"Snake ordering saves {format_duration(raster-seconds)}")
+        if estimate_only:
+            return seconds
+
+        steps = []
+        innermost = len(sweep.axes)-1
+        moves = sweep.moves()
+        setups = [axis for axis in sweep.axes if axis.name in ("Vg","I")]
+        for axis in setups:
+            # the value set by each step, for resuming at the first unfinished one
+            setpoints = [None]*len(setups)+[value if sweep.axes[level] is axis else None for level,value in moves]
+            if axis.name == "Vg":
+                steps.append(Step(partial(self.setup_Vg,axis.values[0],Vg_compliance),rows=0,setup=True,
+                                  resume=partial(self.resume_setup,self.setup_Vg,setpoints,Vg_compliance)))
+            if axis.name == "I":
+                steps.append(Step(partial(self.setup_I,axis.values[0],I_compliance),rows=0,setup=True,
+                                  resume=partial(self.resume_setup,self.setup_I,setpoints,I_compliance)))
+        for level,value in moves:
+            axis = sweep.axes[level]
+            match axis.name:
+                case "Vg":
+                    apply = partial(self.apply_Vg,value)
+                case "I":
+                    apply = partial(self.apply_I,value)
+                case "probe_heater":
+                    apply = partial(self.iTC.set_probe_heater,value)
+                case "VTI_heater":
+                    apply = partial(self.iTC.set_VTI_heater,value)
+                case "probe_T" | "VTI_T" | "T":
+                    controller = {"probe_T":"probe","VTI_T":"VTI","T":"both"}[axis.name]
+                    apply = partial(self.apply_T,controller,value,axis.rate or 0,T_threshold,base_T_threshold)
+                case "B":
+                    apply = partial(self.apply_B,value,axis.rate,B_threshold)
+            if axis.ramped:
+                steps.append(Step(apply,timeout=timeout_hours*3600))
+            else:
+                steps.append(Step(apply,rows=1 if level==innermost else 0,wait=axis.wait))
+        title = "Sweep " + " x ".join([axis.name for axis in sweep.axes])
+        controls_cryostat = any([axis.name not in ("Vg","I") for axis in sweep.axes])
+        self.run(AcquisitionEngine(self,title,steps,message=f"Sweeping {len(steps)} setpoints",
+                                   end_message="Finished sweep",controls_cryostat=controls_cryostat))
+        return seconds
+
+    def get_sweep_values(self,sweep):
+        """Returns the present value of the ramped axes of a sweep"""
+        current = {}
+        for axis in sweep.axes:
+            match axis.name:
+                case "probe_T":
+                    current[axis.name] = self.iTC.get_probe_temp()
+                case "VTI_T":
+                    current[axis.name] = self.iTC.get_VTI_temp()
+                case "T":
+                    current[axis.name] = self.iTC.get_probe_temp()
+                case "B":
+                    current[axis.name] = self.iPS.get_field()
+        return current
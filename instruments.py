@@ -2,39 +2,180 @@ import pyvisa
 import time
 import numpy as np
 import logging
+import threading
+import re
 
 class Instrument():
-    def __init__(self,GPIB_address,mock=False):
-        if mock:
-            rm = pyvisa.ResourceManager('mock_instruments.yaml@sim')
-            print(f"Mocking {GPIB_address}")
-        else:
-            rm = pyvisa.ResourceManager()
-            print(f"Connecting to {GPIB_address}")
+    def __init__(self,GPIB_address,mock=False,mirror=False,mirror_max_age=None,timeout=None,resource=None):
         self.GPIB_address = GPIB_address
-        self.instr = rm.open_resource(GPIB_address,read_termination='\n',write_termination='\n')
+        if resource is not None:
+            # replaces the VISA resource, e.g. a replay.ReplayResource
+            self.instr = resource
+        else:
+            if mock:
+                rm = pyvisa.ResourceManager('mock_instruments.yaml@sim')
+                print(f"Mocking {GPIB_address}")
+            else:
+                rm = pyvisa.ResourceManager()
+                print(f"Connecting to {GPIB_address}")
+            self.instr = rm.open_resource(GPIB_address,read_termination='\n',write_termination='\n')
+        # maximum time to wait for a reply in ms, None keeps the VISA default
+        if timeout is not None:
+            self.instr.timeout = timeout
+        # failed reads, counted by InstrumentGroup.guarded
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.quarantined_until = 0
+        # optional mirror of setpoints written by this process, see remember and recall
+        # entries older than mirror_max_age seconds are read again from the instrument
+        self.mirror = {} if mirror else None
+        self.mirror_max_age = mirror_max_age
+        # False once the instrument has failed to answer a ;-joined message, see batch
+        self.compound = True
+        # held while communicating from a thread, so calls from different threads don't interleave
+        self.lock = threading.RLock()
     def query(self,command):
         # logging.info(f"Query: {command}")
-        response = self.instr.query(command)
+        # the lock keeps each query and its reply together when several threads share the instrument
+        with self.lock:
+            response = self.instr.query(command)
         # logging.info(f"Response: {response}")
         return response
     def write(self,command):
         # logging.info(f"Write: {command}")
-        self.instr.write(command)
+        with self.lock:
+            self.instr.write(command)
     def identify(self):
         return self.query('*IDN?')
+    def recover(self):
+        # called after a failed read, clears the VISA buffers so the next reply isn't a stale one
+        with self.lock:
+            try:
+                self.instr.clear()
+            except pyvisa.VisaIOError:
+                pass
+
+    ### Thread safe access ###
+    def call(self,function,*args):
+        # call a method of this instrument while holding its lock
+        with self.lock:
+            return function(*args)
+
+    ### Batched commands ###
+    @staticmethod
+    def rooted(command):
+        # in a compound message each command is relative to the previous one unless it starts with :
+        return command if command.startswith((':','*')) else ':'+command
+    def batch(self,*commands,wait=True):
+        # send several SCPI commands as one ;-joined message, e.g. batch('SOUR:VOLT 1','OUTP ON')
+        # wait=True appends *OPC?, whose reply comes once every command has completed
+        if not self.compound:
+            with self.lock:
+                for command in commands:
+                    self.write(command)
+                return self.query('*OPC?') if wait else None
+        message = ';'.join(self.rooted(command) for command in commands)
+        if wait:
+            return self.query(message+';*OPC?')
+        self.write(message)
+    def query_batch(self,*commands):
+        # ask several queries in one message and return the list of replies
+        if not self.compound:
+            return [self.query(command) for command in commands]
+        replies = self.query(';'.join(self.rooted(command) for command in commands)).split(';')
+        if len(replies) != len(commands):
+            raise ValueError(f"{self.GPIB_address}: expected {len(commands)} replies, got {len(replies)}")
+        return replies
+    def single_commands(self):
+        # the instrument didn't answer a compound message, usually a timeout
+        # clear the error and send one command at a time from now on
+        self.compound = False
+        self.recover()
+        self.write('*CLS')
+    def configure(self,settings,reset=False):
+        # settings is a list of (command, value) pairs, e.g. (':SENS:FUNC','"VOLT"')
+        # each setting is read back with 'command?' and only written if it differs
+        # reset=True sends *RST and *CLS and then writes every setting
+        # the read-backs and the writes each go in one batched message
+        if reset:
+            commands = ['*RST','*CLS',*[f'{command} {value}' for command,value in settings]]
+            try:
+                self.batch(*commands)
+            except pyvisa.VisaIOError:
+                self.single_commands()
+                self.batch(*commands)
+            self.forget()
+            return
+        queries = [f'{command}?' for command,_ in settings]
+        try:
+            responses = self.query_batch(*queries)
+        except (ValueError,pyvisa.VisaIOError):
+            self.single_commands()
+            responses = self.query_batch(*queries)
+        changes = [f'{command} {value}' for (command,value),response in zip(settings,responses)
+                   if not self.setting_matches(response,value)]
+        if changes:
+            self.batch(*changes)
+
+    ### State mirror ###
+    def remember(self,key,value,getter):
+        # record a value written by this process, getter reads it back from the instrument
+        if self.mirror is not None:
+            self.mirror[key] = (value,time.monotonic(),getter)
+    def recall(self,key,getter):
+        # return the mirrored value if there is a recent one, otherwise query and mirror it
+        if self.mirror is not None and key in self.mirror:
+            value,t,_ = self.mirror[key]
+            if self.mirror_max_age is None or time.monotonic()-t < self.mirror_max_age:
+                return value
+        value = getter()
+        self.remember(key,value,getter)
+        return value
+    def forget(self,key=None):
+        # drop one or all mirrored values, e.g. after *RST
+        if self.mirror is not None:
+            if key is None:
+                self.mirror.clear()
+            else:
+                self.mirror.pop(key,None)
+    def reconcile(self):
+        # read every mirrored value back from the instrument and return those that changed
+        changed = {}
+        if self.mirror is None:
+            return changed
+        for key,(value,_,getter) in list(self.mirror.items()):
+            actual = getter()
+            if actual != value:
+                print(f"{self.GPIB_address}: {key} changed from {value} to {actual}")
+                changed[key] = (value,actual)
+            self.remember(key,actual,getter)
+        return changed
+    @staticmethod
+    def setting_matches(response,value):
+        # compare a SCPI read-back with the value that would be written
+        # responses come back in short form, e.g. 1 for ON and "CURR:DC" for "CURR"
+        aliases = {'ON':'1','OFF':'0'}
+        response = response.strip().strip('"').upper()
+        value = str(value).strip().strip('"').upper()
+        response = aliases.get(response,response)
+        value = aliases.get(value,value)
+        try:
+            return np.isclose(float(response),float(value),rtol=1e-6,atol=0)
+        except ValueError:
+            return response==value or response.startswith(value+':')
 
 class Voltmeter(Instrument):
     # this currently works for both keithley 2182A and keysight 34461A
-    def __init__(self,GPIB_address,**kwargs):
+    settings = [(':SENS:VOLT:RANG:AUTO','ON'),
+                (':SENS:FUNC','"VOLT"')]
+    def __init__(self,GPIB_address,reset=False,**kwargs):
+        # only settings which differ are written, use reset=True to send *RST first
         super().__init__(GPIB_address,**kwargs)
-        self.write('*RST')
-        self.write('*CLS')
-        self.write(':SENS:VOLT:RANG:AUTO ON')
-        self.write(':SENS:FUNC "VOLT"')
+        self.configure(self.settings,reset=reset)
     def write(self,command):
         # logging.info(f"Write: {command}")
-        self.instr.write(command)
+        with self.lock:
+            self.instr.write(command)
         # logging.info(f"Response: {self.instr.query('SYST:ERR?')}")
     def get_voltage(self):
         return float(self.query(':READ?'))
@@ -45,19 +186,23 @@ class Voltmeter(Instrument):
 
 class Sourcemeter(Instrument):
     # works with Keithley 6221
-    def __init__(self,GPIB_address,**kwargs):
+    settings = [(':SOUR:CURR:RANG:AUTO','ON')]
+    def __init__(self,GPIB_address,reset=False,**kwargs):
+        # only settings which differ are written, use reset=True to send *RST first
         super().__init__(GPIB_address,**kwargs)
-        self.write('*RST')
-        self.write('*CLS')
-        self.write(':SOUR:CURR:RANG:AUTO ON')
+        self.configure(self.settings,reset=reset)
     def write(self,command):
         # logging.info(f"Write: {command}")
-        self.instr.write(command)
+        with self.lock:
+            self.instr.write(command)
         # logging.info(f"Response: {self.instr.query('SYST:ERR?')}")
     def set_current(self,current):
         self.write(f'SOUR:CURR {current:.9g}')
+        self.remember('current',float(f'{current:.9g}'),self.read_current)
+    def read_current(self):
+        return float(self.query('SOUR:CURR?'))
     def get_current(self,nanforcompliance=True):
-        I = float(self.query('SOUR:CURR?'))
+        I = self.recall('current',self.read_current)
         if nanforcompliance:
             status=int(self.query('STAT:MEAS:COND?'))
             if status & 8 == 8: # bit 3 on status register = compliance
@@ -65,7 +210,7 @@ class Sourcemeter(Instrument):
                 I = np.nan
         return I
     def reverse_current(self):
-        self.set_current(-float(self.query('SOUR:CURR?')))
+        self.set_current(-self.recall('current',self.read_current))
     def turn_on(self):
         self.write('OUTP ON')
     def turn_off(self):
@@ -74,34 +219,44 @@ class Sourcemeter(Instrument):
         return float(self.query('SOUR:CURR:COMP?'))
     def set_compliance(self,compliance):
         self.write(f'SOUR:CURR:COMP {compliance:.9g}')
+    def setup(self,current,compliance,on=True):
+        # compliance, current and output in one message
+        self.batch(f'SOUR:CURR:COMP {compliance:.9g}',f'SOUR:CURR {current:.9g}',f'OUTP {"ON" if on else "OFF"}')
+        self.remember('current',float(f'{current:.9g}'),self.read_current)
 
 class VSourcemeter(Instrument):
     # works with Keithley 2410
-    def reset(self):
-        self.write('*RST')
-        self.write('*CLS')
-        self.write(':FORM:ELEM VOLT,CURR')
-        self.write(':SOUR:FUNC VOLT')
-        self.write(':SOUR:VOLT:MODE FIXED')
-        self.write(':SOUR:VOLT:RANG:AUTO ON')
-        self.write(':SOUR:VOLT 0.0')
-        self.write(':SENS:FUNC "CURR"')
-        self.write(':SENS:CURR:PROT 1E-7')
-        self.write(':SENS:CURR:RANG:AUTO ON')
-        self.write(':OUTP OFF')
+    settings = [(':FORM:ELEM','VOLT,CURR'),
+                (':SOUR:FUNC','VOLT'),
+                (':SOUR:VOLT:MODE','FIX'),
+                (':SOUR:VOLT:RANG:AUTO','ON'),
+                (':SOUR:VOLT','0.0'),
+                (':SENS:FUNC','"CURR"'),
+                (':SENS:CURR:PROT','1E-7'),
+                (':SENS:CURR:RANG:AUTO','ON'),
+                (':OUTP','OFF')]
+    def reset(self,full=False):
+        # only settings which differ are written, use full=True to send *RST first
+        self.configure(self.settings,reset=full)
+        self.remember('output',0,self.read_output)
     def write(self,command):
         # logging.info(f"Write: {command}")
-        self.instr.write(command)
+        with self.lock:
+            self.instr.write(command)
         # logging.info(f"Response: {self.instr.query('SYST:ERR?')}")
     def turn_on(self):
         self.write('OUTP ON')
+        self.remember('output',1,self.read_output)
     def turn_off(self):
         self.write('OUTP OFF')
+        self.remember('output',0,self.read_output)
+    def read_output(self):
+        return int(self.query('OUTP?'))
     def set_voltage(self,voltage):
         self.write(f'SOUR:VOLT {voltage:.9g}')
     def get_voltage_and_Ileak(self):
         # check whether output is on
-        if int(self.query('OUTP?')) == 1:
+        if self.recall('output',self.read_output) == 1:
             reading = [float(value) for value in self.query(':READ?').split(',')]
             return reading[0],reading[1]
         else:
@@ -114,11 +269,16 @@ class VSourcemeter(Instrument):
         return Ileak
     def set_compliance(self,compliance):
         self.write(f'SENS:CURR:PROT {compliance:.9g}')
+    def setup(self,voltage,compliance):
+        # compliance, voltage and output on in one message
+        self.batch(f'SENS:CURR:PROT {compliance:.9g}',f'SOUR:VOLT {voltage:.9g}','OUTP ON')
+        self.remember('output',1,self.read_output)
 
 class Mercury(Instrument):
     def query(self,command):
         # logging.info(f'Query: {command}')
-        response = self.instr.query(command)
+        with self.lock:
+            response = self.instr.query(command)
         # logging.info(f'Response: {response}')
         # if response.endswith('INVALID'):
             # logging.error(f'Invalid command: {command}')
@@ -128,12 +288,74 @@ class Mercury(Instrument):
         # this would lead to an erroneous response to the next query command
         # so we only use query commands
         # logging.info(f"Write: {command}")
-        response = self.instr.query(command)
+        with self.lock:
+            response = self.instr.query(command)
         # logging.info(f'Response: {response}')
         # if response.endswith('INVALID'):
             # logging.error(f'Invalid command: {command}')
+    def batch(self,*commands):
+        # Mercury controllers take one command per message, so the commands are sent in turn
+        # each reply is checked before the next command, so nothing acts on a rejected setting
+        responses = []
+        with self.lock:
+            for command in commands:
+                response = self.query(command)
+                if response.endswith('INVALID'):
+                    raise RuntimeError(f"{self.GPIB_address}: invalid command {command}")
+                responses.append(response)
+        return responses
+    def confirm(self,path,value,attempts=20,interval=0.05):
+        # poll READ:path? until it gives value, a number or e.g. an action like 'RTOS'
+        for i in range(attempts):
+            reply = self.query(f'READ:{path}?').split(':')[-1]
+            if isinstance(value,str):
+                if reply == value:
+                    return
+            else:
+                number = re.match(r'[-+0-9.eE]*',reply).group()
+                try:
+                    if np.isclose(float(number),value,rtol=1e-3,atol=1e-4):
+                        return
+                except ValueError:
+                    pass
+            time.sleep(interval)
+        raise RuntimeError(f"{self.GPIB_address}: {path} is {reply}, not {value}")
     def get_config(self):
         return self.query('READ:SYS:CAT')
+    def drain(self,timeout=50):
+        # discard whatever is in the receive buffer without waiting for the VISA timeout
+        # serial ports report the bytes waiting, otherwise read with a short timeout
+        if hasattr(self.instr,'bytes_in_buffer'):
+            while self.instr.bytes_in_buffer:
+                self.instr.read_bytes(self.instr.bytes_in_buffer)
+            return
+        previous = self.instr.timeout
+        self.instr.timeout = timeout
+        try:
+            while True:
+                self.instr.read()
+        except pyvisa.VisaIOError as err:
+            if err.abbreviation != 'VI_ERROR_TMO':
+                raise
+        finally:
+            self.instr.timeout = previous
+    def resync(self,attempts=5):
+        # send a query with a known reply and discard late replies until it arrives
+        try:
+            self.instr.write('*IDN?')
+            for i in range(attempts):
+                if self.instr.read().startswith('IDN:'):
+                    return True
+        except pyvisa.VisaIOError:
+            pass
+        return False
+    def recover(self):
+        # a late reply to a timed out query would otherwise be read as the reply to the next one
+        with self.lock:
+            self.drain()
+            resynced = self.resync()
+        if not resynced:
+            print(f"Could not resynchronise {self.GPIB_address}")
 
 class MercuryiPS(Mercury):
     ### Magnet getters ###
@@ -150,10 +372,14 @@ class MercuryiPS(Mercury):
         B = float(response.split(':')[-1][:-1])
         return B
     def get_field_sweep_rate(self): # in T/min
+        return self.recall('field_sweep_rate',self.read_field_sweep_rate)
+    def read_field_sweep_rate(self):
         response = self.query('READ:DEV:GRPZ:PSU:SIG:RFLD?')
         rate = float(response.split(":")[-1][:-5])
         return rate
     def get_field_setpoint(self): # in T
+        return self.recall('field_setpoint',self.read_field_setpoint)
+    def read_field_setpoint(self):
         response = self.query('READ:DEV:GRPZ:PSU:SIG:FSET?')
         B = float(response.split(':')[-1][:-1])
         return B
@@ -176,12 +402,24 @@ class MercuryiPS(Mercury):
             case 2:
                 self.query('SET:DEV:GRPZ:PSU:ACTN:HOLD')
     def set_field(self,B,rate): # in T
-        self.set_output(2)
-        self.query(f'SET:DEV:GRPZ:PSU:SIG:RFST:{rate:.9g}')
-        time.sleep(0.1)
-        self.query(f'SET:DEV:GRPZ:PSU:SIG:FSET:{B:.9g}')
-        time.sleep(0.1)
-        self.set_output(1)
+        # hold, then rate and setpoint, and only ramp once both read back as sent
+        self.batch('SET:DEV:GRPZ:PSU:ACTN:HOLD',
+                   f'SET:DEV:GRPZ:PSU:SIG:RFST:{rate:.9g}',
+                   f'SET:DEV:GRPZ:PSU:SIG:FSET:{B:.9g}')
+        self.confirm('DEV:GRPZ:PSU:SIG:RFST',float(f'{rate:.9g}'))
+        self.confirm('DEV:GRPZ:PSU:SIG:FSET',float(f'{B:.9g}'))
+        self.remember('field_sweep_rate',float(f'{rate:.9g}'),self.read_field_sweep_rate)
+        self.remember('field_setpoint',float(f'{B:.9g}'),self.read_field_setpoint)
+        self.batch('SET:DEV:GRPZ:PSU:ACTN:RTOS')
+        self.confirm_ramping(B)
+    def confirm_ramping(self,B,tol=0.001,attempts=20,interval=0.05):
+        # the iPS goes back to HOLD at the setpoint, so a short or zero length ramp can already read HOLD
+        for i in range(attempts):
+            action = self.query('READ:DEV:GRPZ:PSU:ACTN?').split(':')[-1]
+            if action == 'RTOS' or (action == 'HOLD' and abs(self.get_field()-B) < tol):
+                return
+            time.sleep(interval)
+        raise RuntimeError(f"{self.GPIB_address}: not ramping to {B} T, action is {action}")
     
     ### Temperature getters ###
     def get_magnet_T(self):
@@ -211,23 +449,30 @@ class MercuryiTC(Mercury):
         T_K = float(response.split(':')[-1][:-1])
         return T_K
     def set_probe_temp(self,temp):
-        self.query(f'SET:DEV:DB8.T1:TEMP:LOOP:RENA:OFF')#turn off ramp
-        self.query(f'SET:DEV:DB8.T1:TEMP:LOOP:TSET:{temp:.9g}')#set temp
-        self.query(f'SET:DEV:DB8.T1:TEMP:LOOP:ENAB:ON')#turn on PID loop
+        self.batch('SET:DEV:DB8.T1:TEMP:LOOP:RENA:OFF',#turn off ramp
+                   f'SET:DEV:DB8.T1:TEMP:LOOP:TSET:{temp:.9g}',
+                   'SET:DEV:DB8.T1:TEMP:LOOP:ENAB:ON')#turn on PID loop
+        self.remember('probe_setpoint',float(f'{temp:.9g}'),self.read_probe_setpoint)
         
     def get_probe_setpoint(self):
+        return self.recall('probe_setpoint',self.read_probe_setpoint)
+    def read_probe_setpoint(self):
         response = self.query('READ:DEV:DB8.T1:TEMP:LOOP:TSET?')
         T_K = float(response.split(':')[-1][:-1])
         return T_K
     def get_probe_ramp_rate(self):
+        return self.recall('probe_ramp_rate',self.read_probe_ramp_rate)
+    def read_probe_ramp_rate(self):
         response = self.query('READ:DEV:DB8.T1:TEMP:LOOP:RSET?')
         dTdt_Kpermin = float(response.split(':')[-1][:-3])
         return dTdt_Kpermin
     def ramp_probe_temp(self,temp,rate):
-        self.query(f'SET:DEV:DB8.T1:TEMP:LOOP:RENA:ON')#turn on ramp
-        self.query(f'SET:DEV:DB8.T1:TEMP:LOOP:RSET:{rate:.9g}')
-        self.query(f'SET:DEV:DB8.T1:TEMP:LOOP:TSET:{temp:.9g}')
-        self.query(f'SET:DEV:DB8.T1:TEMP:LOOP:ENAB:ON')#turn on loop
+        self.batch('SET:DEV:DB8.T1:TEMP:LOOP:RENA:ON',#turn on ramp
+                   f'SET:DEV:DB8.T1:TEMP:LOOP:RSET:{rate:.9g}',
+                   f'SET:DEV:DB8.T1:TEMP:LOOP:TSET:{temp:.9g}',
+                   'SET:DEV:DB8.T1:TEMP:LOOP:ENAB:ON')#turn on loop
+        self.remember('probe_ramp_rate',float(f'{rate:.9g}'),self.read_probe_ramp_rate)
+        self.remember('probe_setpoint',float(f'{temp:.9g}'),self.read_probe_setpoint)
         return
     def get_probe_heater(self):
         response = self.query('READ:DEV:DB8.T1:TEMP:LOOP:HSET?')
@@ -251,23 +496,30 @@ class MercuryiTC(Mercury):
         T_K = float(response.split(':')[-1][:-1])
         return T_K
     def set_VTI_temp(self,temp):
-        self.query(f'SET:DEV:MB1.T1:TEMP:LOOP:RENA:OFF')#turn off ramp
-        self.query(f'SET:DEV:MB1.T1:TEMP:LOOP:TSET:{temp:.9g}')
-        self.query(f'SET:DEV:MB1.T1:TEMP:LOOP:ENAB:ON')#turn on PID loop
+        self.batch('SET:DEV:MB1.T1:TEMP:LOOP:RENA:OFF',#turn off ramp
+                   f'SET:DEV:MB1.T1:TEMP:LOOP:TSET:{temp:.9g}',
+                   'SET:DEV:MB1.T1:TEMP:LOOP:ENAB:ON')#turn on PID loop
+        self.remember('VTI_setpoint',float(f'{temp:.9g}'),self.read_VTI_setpoint)
         return
     def get_VTI_setpoint(self):
+        return self.recall('VTI_setpoint',self.read_VTI_setpoint)
+    def read_VTI_setpoint(self):
         response = self.query('READ:DEV:MB1.T1:TEMP:LOOP:TSET?')
         T_K = float(response.split(':')[-1][:-1])
         return T_K
     def get_VTI_ramp_rate(self):
+        return self.recall('VTI_ramp_rate',self.read_VTI_ramp_rate)
+    def read_VTI_ramp_rate(self):
         response = self.query('READ:DEV:MB1.T1:TEMP:LOOP:RSET?')
         dTdt_Kpermin = float(response.split(':')[-1][:-3])
         return dTdt_Kpermin
     def ramp_VTI_temp(self,temp,rate):
-        self.query(f'SET:DEV:MB1.T1:TEMP:LOOP:RENA:ON')#turn on ramp
-        self.query(f'SET:DEV:MB1.T1:TEMP:LOOP:RSET:{rate:.9g}')
-        self.query(f'SET:DEV:MB1.T1:TEMP:LOOP:TSET:{temp:.9g}')
-        self.query(f'SET:DEV:MB1.T1:TEMP:LOOP:ENAB:ON')#turn on loop
+        self.batch('SET:DEV:MB1.T1:TEMP:LOOP:RENA:ON',#turn on ramp
+                   f'SET:DEV:MB1.T1:TEMP:LOOP:RSET:{rate:.9g}',
+                   f'SET:DEV:MB1.T1:TEMP:LOOP:TSET:{temp:.9g}',
+                   'SET:DEV:MB1.T1:TEMP:LOOP:ENAB:ON')#turn on loop
+        self.remember('VTI_ramp_rate',float(f'{rate:.9g}'),self.read_VTI_ramp_rate)
+        self.remember('VTI_setpoint',float(f'{temp:.9g}'),self.read_VTI_setpoint)
         return
     def get_VTI_heater(self):
         response = self.query('READ:DEV:MB1.T1:TEMP:LOOP:HSET?')
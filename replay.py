@@ -0,0 +1,233 @@
+import csv
+import numpy as np
+import pyvisa
+from instruments import Voltmeter, Sourcemeter, VSourcemeter, MercuryiTC, MercuryiPS, Lakeshore
+from instrument_group import InstrumentGroup, open_data_file
+
+# Mercury READ paths and the recorded column they answer with, and the units the getters strip
+MERCURY = {"DEV:MB0.H1:TEMP:SIG:TEMP": ("T_probe", "K"),
+           "DEV:DB8.T1:TEMP:LOOP:TSET": ("T_probe_setpoint", "K"),
+           "DEV:DB8.T1:TEMP:LOOP:RSET": ("T_probe_ramp_rate", "K/m"),
+           "DEV:DB8.T1:TEMP:LOOP:HSET": ("heater_probe", ""),
+           "DEV:MB1.T1:TEMP:SIG:TEMP": ("T_VTI", "K"),
+           "DEV:MB1.T1:TEMP:LOOP:TSET": ("T_VTI_setpoint", "K"),
+           "DEV:MB1.T1:TEMP:LOOP:RSET": ("T_VTI_ramp_rate", "K/m"),
+           "DEV:MB1.T1:TEMP:LOOP:HSET": ("heater_VTI", ""),
+           "DEV:DB5.P1:PRES:SIG:PRES": ("Pressure", "mB"),
+           "DEV:DB5.P1:PRES:LOOP:FSET": ("Needlevalve", ""),
+           "DEV:GRPZ:PSU:SIG:FLD": ("B", "T"),
+           "DEV:GRPZ:PSU:SIG:FSET": ("B_setpoint", "T"),
+           "DEV:GRPZ:PSU:SIG:RFLD": ("B_ramp_rate", "T/min")}
+
+class Trace:
+    """A recorded measurement file, read back one row at a time.
+
+    The file is in the format written by InstrumentGroup, with the column
+    names after the [DATA] line. The trace advances by one recorded row for
+    every row the InstrumentGroup reads, and now() gives the recorded time,
+    so stop conditions see the same temperatures, fields and times as in the
+    original measurement, without waiting. Once the trace has ended the last
+    row is repeated.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open_data_file(filename) as f:
+            reader = csv.reader(f)
+            for line in reader:
+                if line and line[0] == "[DATA]":
+                    break
+            else:
+                raise ValueError(f"No [DATA] line in {filename}")
+            headers = next(reader)
+            rows = [[self.to_float(value) for value in line] for line in reader if line]
+        self.names = [header.split(" (")[0] for header in headers]
+        self.data = np.array(rows,dtype=float).reshape(-1,len(self.names))
+        if len(self.data) == 0:
+            raise ValueError(f"No data in {filename}")
+        # Time restarts at each setpoint, count it up over the whole file
+        if "Time" in self.names:
+            times = self.data[:,self.names.index("Time")]
+            steps = np.diff(times,prepend=times[0])
+            restarts = steps < 0
+            steps[restarts] = times[restarts]
+            self.times = np.cumsum(steps)
+        else:
+            self.times = np.arange(len(self.data),dtype=float)
+        # time per row after the end, 1 s if the times weren't recorded
+        self.row_time = self.times[-1]/(len(self.times)-1) if len(self.times) > 1 else 0
+        if not self.row_time > 0:
+            self.row_time = 1
+        self.index = -1
+        self.ended = False
+        # time added after the end, so timeouts still end the measurement
+        self.overrun = 0
+
+    @staticmethod
+    def to_float(value):
+        try:
+            return float(value)
+        except ValueError:
+            return np.nan
+
+    def __len__(self):
+        return len(self.data)
+
+    def advance(self):
+        """Moves on to the next recorded row"""
+        if self.index+1 < len(self.data):
+            self.index += 1
+            return
+        if not self.ended:
+            self.ended = True
+            print(f"End of trace {self.filename}, repeating the last row")
+        self.overrun += self.row_time
+
+    def now(self):
+        """Returns the recorded time of the current row in seconds"""
+        return self.times[max(self.index,0)] + self.overrun
+
+    def get(self, name):
+        """Returns the value of a column in the current row, NaN if it wasn't recorded"""
+        if name not in self.names:
+            return np.nan
+        return self.data[max(self.index,0),self.names.index(name)]
+
+class ReplayResource:
+    """Answers an instrument's queries with the values of the current row of
+    a Trace.
+
+    Mercury READ commands get the recorded column. A voltmeter answers its
+    first :FETC? of a row with V+ and the second with V-, a sourcemeter
+    answers with I until it is set, and a Lakeshore answers so that the mean
+    and spread of its readings are T_sample and T_sample_err. Setters are
+    accepted, and only read back within the row they are sent in.
+    """
+    def __init__(self, trace, kind, name=None):
+        self.trace = trace
+        self.kind = kind
+        self.name = name
+        self.timeout = 2000
+        self.index = None
+        self.counts = {}
+        self.state = {}
+        self.pending = []
+
+    def new_row(self):
+        # repeated queries of one row are counted, and setpoints only last for the row
+        if self.index != self.trace.index:
+            self.index = self.trace.index
+            self.counts = {}
+            self.state = {}
+
+    def count(self, command):
+        self.counts[command] = self.counts.get(command,0)+1
+        return self.counts[command]-1
+
+    def query(self, command):
+        self.new_row()
+        if ';' in command:
+            # a batched message, setters are applied and the queries answered together
+            replies = []
+            for part in command.split(';'):
+                if '?' in part:
+                    replies.append(self.query(part))
+                else:
+                    self.write(part)
+            return ';'.join(replies)
+        trace = self.trace
+        if command == '*IDN?':
+            return 'IDN:REPLAY'
+        if command == '*OPC?':
+            return '1'
+        if command.startswith('SET:'):
+            path,_,value = command[4:].rpartition(':')
+            self.state[path] = value
+            return f'STAT:{command}:VALID'
+        if command.startswith('READ:'):
+            path = command[5:].rstrip('?')
+            if path in self.state:
+                # a setting sent in this row, e.g. read back to confirm it
+                return f'STAT:{path}:{self.state[path]}'
+            name,unit = MERCURY.get(path,(None,""))
+            return f'STAT:{path}:{trace.get(name)}{unit}'
+        match self.kind, command:
+            case 'Voltmeter', ':FETC?':
+                sign = "+-"[self.count(command) % 2]
+                return str(trace.get(f"V{sign}_{self.name}"))
+            case 'Voltmeter', ':READ?':
+                return str(trace.get(f"V+_{self.name}"))
+            case 'Sourcemeter', 'SOUR:CURR?':
+                return self.state.get('SOUR:CURR',str(trace.get(f"I_{self.name}")))
+            case 'Sourcemeter', 'STAT:MEAS:COND?':
+                # compliance was recorded as NaN
+                return '8' if np.isnan(trace.get(f"I_{self.name}")) else '0'
+            case 'VSourcemeter', ':READ?':
+                return f'{trace.get(f"Vg_{self.name}")},{trace.get(f"Ileak_{self.name}")}'
+            case 'VSourcemeter', 'OUTP?':
+                return '0' if np.isnan(trace.get(f"Vg_{self.name}")) else '1'
+            case 'Lakeshore', _:
+                T = trace.get("T_sample")
+                err = trace.get("T_sample_err")
+                if np.isnan(err):
+                    err = 0
+                return str([T-err/2,T+err/2,T][self.count(command) % 3])
+        return self.state.get(command.rstrip('?').lstrip(':'),'0')
+
+    def write(self, command):
+        self.new_row()
+        if command == '*IDN?':
+            self.pending.append('IDN:REPLAY')
+            return
+        for part in command.split(';'):
+            if ' ' in part:
+                setting,value = part.split(' ',1)
+                self.state[setting.lstrip(':')] = value
+
+    def read(self):
+        if self.pending:
+            return self.pending.pop(0)
+        raise pyvisa.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+
+    def clear(self):
+        self.pending = []
+
+def replay_instruments(trace):
+    """Returns the keyword arguments of an InstrumentGroup with instruments
+    replaying the columns recorded in the trace"""
+    names = trace.names
+    def named(prefix):
+        return [name[len(prefix):] for name in names if name.startswith(prefix)]
+    kwargs = {}
+    kwargs["voltmeters"] = [(name,Voltmeter(f"replay V {name}",resource=ReplayResource(trace,"Voltmeter",name)))
+                            for name in named("V+_")]
+    kwargs["sourcemeters"] = [(name,Sourcemeter(f"replay I {name}",resource=ReplayResource(trace,"Sourcemeter",name)))
+                              for name in named("I_")]
+    kwargs["Vsourcemeters"] = [(name,VSourcemeter(f"replay Vg {name}",resource=ReplayResource(trace,"VSourcemeter",name)))
+                               for name in named("Vg_")]
+    if "T_probe" in names or "T_VTI" in names:
+        kwargs["iTC"] = MercuryiTC("replay iTC",resource=ReplayResource(trace,"MercuryiTC"))
+    if "B" in names:
+        kwargs["iPS"] = MercuryiPS("replay iPS",resource=ReplayResource(trace,"MercuryiPS"))
+    if "T_sample" in names:
+        kwargs["lakeshore"] = Lakeshore("replay Lakeshore",resource=ReplayResource(trace,"Lakeshore"))
+    return kwargs
+
+def replay_group(trace_file, **kwargs):
+    """Returns an InstrumentGroup whose instruments replay a recorded file.
+
+    Measurement modes run as fast as the rows can be processed, with the
+    recorded values and times. Nothing is written to file unless a filename
+    is given. Only the recorded channels are enabled.
+
+    Example
+    -------
+    IG = replay_group("data/ramp_T_probe.csv")
+    IG.ramp_T("probe",1.5,0.5)
+    """
+    trace = Trace(trace_file)
+    kwargs.setdefault("measure",False)
+    group = InstrumentGroup(**replay_instruments(trace),**kwargs)
+    group.trace = trace
+    group.select_channels(*[name for name in trace.names if name in
+                            [channel.name for channel in group.channels]])
+    return group
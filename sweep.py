@@ -0,0 +1,149 @@
+import numpy as np
+
+# quantities which can be swept, stepped ones record one row per value,
+# ramped ones record continuously until the setpoint is reached
+STEPPED = ("Vg", "I", "probe_heater", "VTI_heater")
+RAMPED = ("probe_T", "VTI_T", "T", "B")
+
+class Axis:
+    """One axis of an InstrumentGroup.sweep.
+
+    Parameters
+    ----------
+    name : str
+        The quantity to sweep, one of 'Vg', 'I', 'probe_heater', 'VTI_heater',
+        'probe_T', 'VTI_T', 'T' (probe and VTI together) or 'B'.
+    values : float or list of floats or numpy array of floats
+        The setpoints in V, A, %, K or T.
+    rate : float, optional
+        The ramp rate in K/min for temperatures or T/min for the field. A
+        temperature rate of 0 sets the temperature directly. Required for B.
+    wait : float, optional
+        The time to wait before each row of a stepped axis in seconds.
+        Default is 0.1.
+    snake : bool, optional
+        If True, the axis changes direction every time an outer axis moves,
+        so it doesn't return to its first value. Default is True.
+    reverse : bool, optional
+        If True, the values are swept in reverse order. Default is False.
+    """
+    def __init__(self, name, values, rate=None, wait=0.1, snake=True, reverse=False):
+        if name not in STEPPED + RAMPED:
+            raise ValueError(f"Invalid axis {name}, use one of {STEPPED + RAMPED}")
+        if name == "B" and not rate:
+            raise ValueError("A ramp rate is required for B")
+        self.name = name
+        self.values = list(values) if hasattr(values,'__iter__') else [values]
+        if reverse:
+            self.values = self.values[::-1]
+        self.rate = rate
+        self.wait = wait
+        self.snake = snake
+
+    @property
+    def ramped(self):
+        return self.name in RAMPED
+
+class Sweep:
+    """The order of the setpoints of a nested sweep.
+
+    The first axis is the outermost. Every time an axis moves, the axes
+    inside it run through all their values. Snake axes alternate direction,
+    so consecutive points are as close as possible and e.g. the magnet is
+    not ramped back to the start of each field sweep.
+    """
+    def __init__(self, axes):
+        self.axes = list(axes)
+        if not self.axes:
+            raise ValueError("A sweep needs at least one axis")
+
+    def start_nearest(self, current):
+        """Reverses ramped axes which start further from the current value
+        than they end.
+
+        current is a dict of the present value of each axis name, names
+        without a value are left unchanged.
+        """
+        for axis in self.axes:
+            value = current.get(axis.name)
+            if axis.ramped and value is not None and len(axis.values) > 1:
+                if abs(axis.values[-1]-value) < abs(axis.values[0]-value):
+                    axis.values = axis.values[::-1]
+
+    def moves(self, snake=True):
+        """Returns the setpoints in sweep order as (axis index, value) pairs.
+
+        A move is listed every time an axis is set, moves of a ramped axis to
+        the value it already has are left out. If snake is False every axis
+        restarts from its first value.
+        """
+        orders = [axis.values for axis in self.axes]
+        last = [None]*len(self.axes)
+        moves = []
+        def visit(level):
+            axis = self.axes[level]
+            for value in orders[level]:
+                if not (axis.ramped and value == last[level]):
+                    moves.append((level,value))
+                last[level] = value
+                if level+1 < len(self.axes):
+                    visit(level+1)
+            if snake and axis.snake:
+                orders[level] = orders[level][::-1]
+        visit(0)
+        return moves
+
+    def points(self):
+        """Returns the number of points of the sweep"""
+        return int(np.prod([len(axis.values) for axis in self.axes]))
+
+    def estimate(self, row_time, current=None, snake=True):
+        """Estimates the time and number of rows of the sweep.
+
+        Ramps take their distance divided by the rate, plus the rows the stop
+        condition counts at the setpoint. Setting a temperature directly is
+        counted as one minute. Stepped points take wait plus one row, except
+        on outer axes which record no rows.
+
+        Parameters
+        ----------
+        row_time : float
+            The time to read one row in seconds.
+        current : dict, optional
+            The present value of each axis name. Ramps from unknown values
+            are counted from the first setpoint.
+        snake : bool, optional
+            Whether to estimate the snake order or the plain order.
+
+        Returns
+        -------
+        seconds : float
+        rows : int
+        """
+        current = dict(current or {})
+        innermost = len(self.axes)-1
+        seconds = 0
+        rows = 0
+        for level,value in self.moves(snake):
+            axis = self.axes[level]
+            if not axis.ramped:
+                if level == innermost:
+                    seconds += axis.wait + row_time
+                    rows += 1
+                continue
+            start = current.get(axis.name,value)
+            # RampBCondition counts 10 rows at the setpoint, RampTCondition 30
+            settle = (10 if axis.name == "B" else 30)*row_time
+            ramp = 60*abs(value-start)/axis.rate if axis.rate else 60
+            duration = ramp+settle
+            seconds += duration
+            rows += int(duration/row_time)
+            current[axis.name] = value
+        return seconds, rows
+
+def format_duration(seconds):
+    """Returns a duration as e.g. '3 h 20 min'"""
+    minutes = int(round(seconds/60))
+    if minutes < 60:
+        return f"{minutes} min" if minutes else f"{seconds:.0f} s"
+    return f"{minutes//60} h {minutes%60} min"